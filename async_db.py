@@ -0,0 +1,110 @@
+"""Awaitable versions of the database helpers.
+
+Every call runs on a small pool of database threads so disk latency and
+lock waits never block the Telethon event loop. The number of calls that
+may wait for a thread is bounded; callers beyond that wait their turn.
+"""
+import asyncio
+import os
+import time
+import database
+import metrics
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+
+DB_THREADS = database.READER_POOL_SIZE + 1  # One per reader connection plus the writer
+DB_QUEUE_SIZE = 256  # Calls allowed in flight before new ones wait
+
+executor = ThreadPoolExecutor(max_workers=DB_THREADS, thread_name_prefix="db")
+queue_slots = None  # Backpressure on DB calls; run() builds it on first await, again after a fork
+
+metrics.describe("db_call", "histogram", "Database helper calls", ["call"])
+
+
+def _timed(func, args):
+    start = time.perf_counter()
+    try:
+        return func(*args)
+    except Exception:
+        metrics.inc("db_call_errors_total", func.__name__)
+        raise
+    finally:
+        metrics.observe("db_call_seconds", time.perf_counter() - start, func.__name__)
+
+
+async def run(func, *args):
+    """Runs a blocking database function on the DB threads and returns its result."""
+    global queue_slots
+    if queue_slots is None:
+        queue_slots = asyncio.Semaphore(DB_QUEUE_SIZE)
+
+    async with queue_slots:
+        return await asyncio.get_running_loop().run_in_executor(executor, _timed, func, args)
+
+
+def _reset_after_fork():
+    """A forked worker process gets its own DB threads."""
+    global executor, queue_slots
+    executor = ThreadPoolExecutor(max_workers=DB_THREADS, thread_name_prefix="db")
+    queue_slots = None
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def shutdown():
+    """Waits for queued calls to finish and stops the DB threads."""
+    executor.shutdown(wait=True)
+
+
+def _awaitable(func):
+    @wraps(func)
+    async def wrapper(*args):
+        return await run(func, *args)
+    return wrapper
+
+
+async def add_user(user_id, username):
+    """Adds a user if they don't already exist; known users never leave the event loop."""
+    if user_id in database.known_users:
+        return
+    await run(database.add_user, user_id, username)
+
+
+async def add_chat_member(chat_id, user_id):
+    """Records a group member; members already known never leave the event loop."""
+    if (chat_id, user_id) in database.known_members:
+        return
+    await run(database.add_chat_member, chat_id, user_id)
+
+
+async def get_shop_items():
+    """Returns today's shop; once it's stocked this never leaves the event loop."""
+    items = database.shop_catalogue.get(database.shop_date())
+    if items is not None:
+        return list(items.items())
+    return await run(database.get_shop_items)
+
+
+add_pokemon = _awaitable(database.add_pokemon)
+get_user_stats = _awaitable(database.get_user_stats)
+get_collection = _awaitable(database.get_collection)
+get_collection_page = _awaitable(database.get_collection_page)
+get_pokemon_count = _awaitable(database.get_pokemon_count)
+get_pokecoins = _awaitable(database.get_pokecoins)
+update_pokecoins = _awaitable(database.update_pokecoins)
+update_battle_wins = _awaitable(database.update_battle_wins)
+distribute_rewards = _awaitable(database.distribute_rewards)
+evolve_pokemon = _awaitable(database.evolve_pokemon)
+stock_shop = _awaitable(database.stock_shop)
+prune_shop = _awaitable(database.prune_shop)
+buy_pokemon = _awaitable(database.buy_pokemon)
+add_resource = _awaitable(database.add_resource)
+add_pokemon_to_user = _awaitable(database.add_pokemon_to_user)
+get_drop_times = _awaitable(database.get_drop_times)
+set_drop_time = _awaitable(database.set_drop_time)
+get_cached_response = _awaitable(database.get_cached_response)
+store_cached_response = _awaitable(database.store_cached_response)
+get_media_refs = _awaitable(database.get_media_refs)
+set_media_ref = _awaitable(database.set_media_ref)
+delete_media_ref = _awaitable(database.delete_media_ref)
+flush_writes = _awaitable(database.flush_writes)
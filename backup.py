@@ -0,0 +1,98 @@
+"""Scheduled, compressed database backups.
+
+Each backup copies the live database with SQLite's online backup API in a
+single step on a worker thread. That step is one read transaction, so the
+copy is consistent and, with the database in WAL mode, writers carry on
+while it runs. (Copying in several steps would restart whenever another
+connection wrote in between, which the write-behind flush does every few
+seconds.) The copy is gzipped into
+BACKUP_DIR and only the newest BACKUP_KEEP files are kept. /backup sends the
+newest finished file, it never touches the live database.
+"""
+import asyncio
+import gzip
+import os
+import shutil
+import sqlite3
+import threading
+import time
+import database
+
+BACKUP_DIR = "backups"
+BACKUP_INTERVAL = 6 * 60 * 60  # Seconds between scheduled backups
+BACKUP_KEEP = 7  # Compressed backups kept on disk
+BACKUP_PREFIX = "pokemon_game-"
+BACKUP_SUFFIX = ".db.gz"
+
+backup_lock = threading.Lock()  # One backup at a time
+
+
+def list_backups():
+    """Returns finished backup paths, oldest first."""
+    if not os.path.isdir(BACKUP_DIR):
+        return []
+    names = sorted(name for name in os.listdir(BACKUP_DIR)
+                   if name.startswith(BACKUP_PREFIX) and name.endswith(BACKUP_SUFFIX))
+    return [os.path.join(BACKUP_DIR, name) for name in names]
+
+
+def latest_backup():
+    """Returns the newest finished backup, or None."""
+    backups = list_backups()
+    return backups[-1] if backups else None
+
+
+def create_backup():
+    """Takes a consistent copy of the database, compresses it and prunes old backups.
+
+    Blocking, run it on a worker thread. Returns the new backup's path.
+    """
+    with backup_lock:
+        os.makedirs(BACKUP_DIR, exist_ok=True)
+        database.flush_writes()  # Include queued users and catches
+
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        path = os.path.join(BACKUP_DIR, f"{BACKUP_PREFIX}{stamp}{BACKUP_SUFFIX}")
+        raw_path = path + ".raw.tmp"
+        gz_path = path + ".tmp"
+
+        try:
+            source = sqlite3.connect(database.DB_PATH)
+            target = sqlite3.connect(raw_path)
+            try:
+                source.backup(target)  # All pages in one step, from one snapshot
+            finally:
+                target.close()
+                source.close()
+
+            with open(raw_path, "rb") as raw, gzip.open(gz_path, "wb", compresslevel=6) as compressed:
+                shutil.copyfileobj(raw, compressed, 1024 * 1024)
+            os.replace(gz_path, path)
+        finally:
+            for leftover in (raw_path, gz_path):
+                if os.path.exists(leftover):
+                    os.remove(leftover)
+
+        for old in list_backups()[:-BACKUP_KEEP]:
+            os.remove(old)
+
+    print(f"🟢 Database backed up to {path} ({os.path.getsize(path) // 1024} KB)")
+    return path
+
+
+async def run_backup():
+    """Creates a backup without blocking the event loop."""
+    return await asyncio.get_running_loop().run_in_executor(None, create_backup)
+
+
+async def schedule_backups(interval=BACKUP_INTERVAL):
+    """Backs up every `interval` seconds, counting from the newest backup on disk."""
+    while True:
+        latest = latest_backup()
+        age = time.time() - os.path.getmtime(latest) if latest else interval
+        await asyncio.sleep(max(0, interval - age))
+        try:
+            await run_backup()
+        except (OSError, sqlite3.Error) as e:
+            print(f"⚠️ Backup failed: {e}")
+            await asyncio.sleep(60)  # Don't spin on a persistent error
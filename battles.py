@@ -0,0 +1,97 @@
+"""Battle sessions.
+
+Both players of a match point to the same Battle object in `sessions`, so a
+lookup by either user ID is one dict access and a match is removed in one
+step. Every turn pushes the deadline forward; sessions whose deadline has
+passed are handed out by `expired()` for the sweeper to close.
+"""
+import time
+
+TURN_TIMEOUT = 120  # Seconds a player may take to pick a stat
+SWEEP_INTERVAL = 15  # Seconds between checks for abandoned battles
+
+sessions = {}  # User ID -> Battle (both players share one object)
+
+
+class Battle:
+    __slots__ = ("players", "pokemon", "scores", "chosen", "history", "deadline")
+
+    def __init__(self, player1, player2, pokemon1, pokemon2):
+        self.players = (player1, player2)
+        self.pokemon = (list(pokemon1), list(pokemon2))  # Remaining lineup, sent out in order
+        self.scores = [0, 0]
+        self.chosen = [None, None]  # Stat picked this round
+        self.history = []  # One result message per round
+        self.deadline = 0.0
+        self.touch()
+
+    def touch(self):
+        """Gives the players another TURN_TIMEOUT seconds."""
+        self.deadline = time.time() + TURN_TIMEOUT
+
+    def side(self, user_id):
+        return 0 if user_id == self.players[0] else 1
+
+    def opponent(self, user_id):
+        return self.players[1 - self.side(user_id)]
+
+    def choose(self, user_id, stat):
+        """Records a player's stat for this round. Returns True once both have picked."""
+        self.chosen[self.side(user_id)] = stat
+        self.touch()
+        return None not in self.chosen
+
+    def to_list(self):
+        return [list(self.players), [list(lineup) for lineup in self.pokemon], self.scores,
+                self.chosen, self.history, self.deadline]
+
+    @classmethod
+    def from_list(cls, data):
+        players, pokemon, scores, chosen, history, deadline = data
+        battle = cls(players[0], players[1], pokemon[0], pokemon[1])
+        battle.scores = scores
+        battle.chosen = chosen
+        battle.history = history
+        battle.deadline = deadline
+        return battle
+
+
+def start(player1, player2, pokemon1, pokemon2):
+    """Creates a session for two players and returns it."""
+    battle = Battle(player1, player2, pokemon1, pokemon2)
+    sessions[player1] = battle
+    sessions[player2] = battle
+    return battle
+
+
+def get(user_id):
+    """Returns the battle a user is in, or None."""
+    return sessions.get(user_id)
+
+
+def end(battle):
+    """Removes a session for both players."""
+    for player in battle.players:
+        if sessions.get(player) is battle:
+            del sessions[player]
+
+
+def expired(now=None):
+    """Returns the distinct sessions whose turn deadline has passed."""
+    now = time.time() if now is None else now
+    found = {id(battle): battle for battle in sessions.values() if battle.deadline < now}
+    return list(found.values())
+
+
+def dump():
+    """Sessions for the snapshot, one entry per match."""
+    seen = {id(battle): battle for battle in sessions.values()}
+    return [battle.to_list() for battle in seen.values()]
+
+
+def load(data):
+    sessions.clear()
+    for entry in data:
+        battle = Battle.from_list(entry)
+        for player in battle.players:
+            sessions[player] = battle
@@ -0,0 +1,210 @@
+"""A stand-in for the parts of Telethon that main.py uses.
+
+install() puts fake `telethon` modules into sys.modules, so importing main.py
+registers its handlers on a FakeClient instead of connecting to Telegram.
+The client records everything the bot sends, and dispatch() runs the
+matching handlers for a fake event the way Telethon would.
+"""
+import asyncio
+import itertools
+import re
+import sys
+import types as module_types
+
+message_ids = itertools.count(1)
+
+
+class FakeError(Exception):
+    def __init__(self, *args, seconds=0, **kwargs):
+        super().__init__(*args)
+        self.seconds = seconds
+
+
+class Entity:
+    def __init__(self, user_id, username=None):
+        self.id = user_id
+        self.username = username or f"user{user_id}"
+        self.first_name = self.username.capitalize()
+
+
+class Photo:
+    def __init__(self):
+        self.id = next(message_ids)
+        self.access_hash = self.id * 7
+        self.file_reference = b"ref"
+
+
+class Message:
+    def __init__(self, chat_id, text="", file=None, buttons=None):
+        self.id = next(message_ids)
+        self.chat_id = chat_id
+        self.text = text
+        self.buttons = buttons
+        self.photo = Photo() if file is not None else None
+
+
+class NewMessage:
+    def __init__(self, pattern=None, **kwargs):
+        self.pattern = re.compile(pattern).match if isinstance(pattern, str) else pattern
+
+    def matches(self, event):
+        if not isinstance(event, MessageEvent):
+            return None
+        if self.pattern is None:
+            return True
+        return self.pattern(event.raw_text)
+
+
+class CallbackQuery(NewMessage):
+    def matches(self, event):
+        if not isinstance(event, CallbackEvent):
+            return None
+        if self.pattern is None:
+            return True
+        return self.pattern(event.data.decode())
+
+
+class Button:
+    @staticmethod
+    def inline(text, data=None):
+        return (text, data)
+
+
+class FakeClient:
+    run_hook = None  # Coroutine function run by run_until_disconnected() in place of listening
+
+    def __init__(self, *args, **kwargs):
+        self.handlers = []  # (event builder, callback)
+        self.sent = []  # (method, chat_id, text or caption, file)
+        self.latency = 0.0  # Simulated seconds per Telegram request
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def start(self, *args, **kwargs):
+        return self
+
+    def on(self, builder):
+        def decorator(func):
+            self.add_event_handler(func, builder)
+            return func
+        return decorator
+
+    def add_event_handler(self, callback, builder):
+        if isinstance(builder, type):  # @bot.on(events.NewMessage) passes the class itself
+            builder = builder()
+        self.handlers.append((builder, callback))
+
+    async def _request(self, method, chat_id, text, file=None):
+        self.sent.append((method, chat_id, text, file))
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    async def send_message(self, chat_id, text="", buttons=None, **kwargs):
+        await self._request("send_message", chat_id, text)
+        return Message(chat_id, text, buttons=buttons)
+
+    async def send_file(self, chat_id, file, caption="", buttons=None, **kwargs):
+        await self._request("send_file", chat_id, caption, file)
+        return Message(chat_id, caption, file=file, buttons=buttons)
+
+    async def edit_message(self, chat_id, message_id, text="", buttons=None, **kwargs):
+        await self._request("edit_message", chat_id, text)
+        return Message(chat_id, text, buttons=buttons)
+
+    async def get_entity(self, user_id):
+        await self._request("get_entity", user_id, "")
+        return Entity(user_id)
+
+    def run_until_disconnected(self):
+        hook = type(self).run_hook  # Looked up on the class so it isn't bound to the client
+        if hook is not None:
+            self.loop.run_until_complete(hook())
+
+    async def dispatch(self, event):
+        """Runs every handler whose builder matches, in registration order."""
+        event.client = self
+        for builder, callback in self.handlers:
+            match = builder.matches(event)
+            if match:
+                event.pattern_match = match
+                await callback(event)
+
+
+class MessageEvent:
+    def __init__(self, chat_id, sender_id, text, username=None, reply_to_sender=None):
+        self.chat_id = chat_id
+        self.sender_id = sender_id
+        self.sender = Entity(sender_id, username)
+        self.raw_text = text
+        self.is_private = chat_id == sender_id
+        self.id = next(message_ids)
+        self.message = module_types.SimpleNamespace(is_reply=reply_to_sender is not None, text=text)
+        self.reply_to_sender = reply_to_sender
+        self.pattern_match = None
+        self.client = None
+
+    async def reply(self, text="", **kwargs):
+        return await self.client.send_message(self.chat_id, text, **kwargs)
+
+    async def respond(self, text="", **kwargs):
+        return await self.client.send_message(self.chat_id, text, **kwargs)
+
+    async def get_reply_message(self):
+        return module_types.SimpleNamespace(sender_id=self.reply_to_sender)
+
+
+class CallbackEvent(MessageEvent):
+    def __init__(self, chat_id, sender_id, data, message_text=""):
+        super().__init__(chat_id, sender_id, "")
+        self.data = data.encode()
+        self.message_text = message_text
+
+    async def answer(self, text=None, alert=False):
+        pass
+
+    async def edit(self, text="", file=None, buttons=None, **kwargs):
+        if file is not None:
+            await self.client._request("send_file", self.chat_id, text, file)
+            return Message(self.chat_id, text, file=file)
+        return await self.client.edit_message(self.chat_id, 0, text)
+
+    async def get_message(self):
+        return Message(self.chat_id, self.message_text)
+
+
+def install():
+    """Registers the fake modules under the real Telethon names."""
+    telethon = module_types.ModuleType("telethon")
+    events = module_types.ModuleType("telethon.events")
+    errors = module_types.ModuleType("telethon.errors")
+    tl_types = module_types.ModuleType("telethon.types")
+    tl = module_types.ModuleType("telethon.tl")
+    functions = module_types.ModuleType("telethon.tl.functions")
+    users = module_types.ModuleType("telethon.tl.functions.users")
+
+    events.NewMessage = NewMessage
+    events.CallbackQuery = CallbackQuery
+    for name in ("FileReferenceExpiredError", "FileReferenceInvalidError", "FileReferenceEmptyError",
+                 "MediaEmptyError", "PhotoInvalidError", "MessageNotModifiedError", "FloodWaitError", "RPCError"):
+        setattr(errors, name, type(name, (FakeError,), {}))
+    tl_types.InputPhoto = lambda photo_id, access_hash, file_reference: ("photo", photo_id)
+    users.GetFullUserRequest = object
+
+    telethon.TelegramClient = FakeClient
+    telethon.events = events
+    telethon.errors = errors
+    telethon.types = tl_types
+    telethon.Button = Button
+    telethon.tl = tl
+    tl.functions = functions
+    functions.users = users
+
+    sys.modules.update({
+        "telethon": telethon,
+        "telethon.events": events,
+        "telethon.errors": errors,
+        "telethon.types": tl_types,
+        "telethon.tl": tl,
+        "telethon.tl.functions": functions,
+        "telethon.tl.functions.users": users,
+    })
@@ -0,0 +1,61 @@
+"""A local PokeAPI that serves the JSON files under bench/fixtures.
+
+A request for /api/v2/<resource>/<name>/ is answered with
+fixtures/<resource>/<name>.json, "{base}" inside it replaced by the stub's
+own URL so follow-up links (like evolution chains) stay local. Anything
+else is a 404, just like PokeAPI for an unknown name.
+"""
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+
+class PokeAPIStub:
+    def __init__(self, latency=0.0):
+        self.latency = latency  # Simulated seconds per request
+        self.requests = 0
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self.base_url = f"http://127.0.0.1:{self.server.server_port}/api/v2"
+        self.thread = threading.Thread(target=self.server.serve_forever, name="pokeapi-stub", daemon=True)
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                stub.requests += 1
+                if stub.latency:
+                    threading.Event().wait(stub.latency)
+
+                parts = self.path.strip("/").split("/")
+                path = None
+                if len(parts) == 4 and parts[:2] == ["api", "v2"]:
+                    path = os.path.join(FIXTURES_DIR, parts[2], f"{parts[3]}.json")
+
+                if path is None or not os.path.exists(path):
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+
+                with open(path, encoding="utf-8") as f:
+                    body = f.read().replace("{base}", stub.base_url).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
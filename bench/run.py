@@ -0,0 +1,304 @@
+"""Replays synthetic traffic through main.py's handlers and reports what it cost.
+
+Usage (from the repository root):
+    python -m bench.run [--chats 20] [--users 200] [--messages 5000] ...
+                        [--output results.json] [--compare previous.json]
+
+Telegram is replaced by bench/fake_telethon.py and PokeAPI by a local stub
+serving bench/fixtures, and the bot runs against a fresh database in a
+temporary directory. Results (throughput, p50/p90/p99 latency per scenario,
+database, HTTP and Telegram call counts) are printed and written as JSON
+to compare runs between commits.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from bench import fake_telethon
+from bench.pokeapi_stub import PokeAPIStub
+
+SPAWN_CAPTION = "A wild Pokémon appeared"
+STAT_PICKS = ("hp", "attack", "defense", "sp_attack", "sp_defense", "speed")
+CHATTER = ("hi", "lol", "anyone up?", "gg", "that was close", "brb", "nice", "pikachu is the best",
+           "what level are you", "ok")
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(q * (len(sorted_values) - 1) + 0.5))]
+
+
+class Recorder:
+    """Collects handler latencies per scenario."""
+
+    def __init__(self):
+        self.latencies = {}  # Scenario -> [seconds]
+        self.wall = {}  # Scenario -> seconds spent in its phase
+
+    async def timed(self, scenario, client, event):
+        start = time.perf_counter()
+        await client.dispatch(event)
+        self.latencies.setdefault(scenario, []).append(time.perf_counter() - start)
+
+    def summary(self):
+        result = {}
+        for scenario, values in self.latencies.items():
+            values = sorted(values)
+            wall = self.wall.get(scenario)
+            result[scenario] = {
+                "count": len(values),
+                "throughput_per_s": round(len(values) / wall, 1) if wall else None,
+                "p50_ms": round(percentile(values, 0.50) * 1000, 3),
+                "p90_ms": round(percentile(values, 0.90) * 1000, 3),
+                "p99_ms": round(percentile(values, 0.99) * 1000, 3),
+                "max_ms": round(values[-1] * 1000, 3),
+            }
+        return result
+
+
+async def bounded(coros, concurrency):
+    """Runs coroutines with at most `concurrency` in flight."""
+    slots = asyncio.Semaphore(concurrency)
+
+    async def run(coro):
+        async with slots:
+            await coro
+
+    await asyncio.gather(*(run(coro) for coro in coros))
+
+
+def spawned_name(main, file):
+    """Works out which Pokémon a spawn photo shows."""
+    import pokedex
+    if isinstance(file, str):
+        for entry in pokedex.species_by_name.values():
+            if entry["image"] == file:
+                return entry["name"]
+    for name, ref in main.media_refs.items():
+        if ref == file:
+            return name
+    return None
+
+
+async def replay(args, recorder):
+    main = sys.modules["main"]
+    import database
+    import game_logic
+    import battles
+    import outbox
+
+    client = main.bot
+    client.latency = args.telegram_latency
+    rng = random.Random(args.seed)
+    chats = [-(1000 + i) for i in range(args.chats)]
+    users = [10_000 + i for i in range(args.users)]
+
+    for chat_id in chats:
+        if main.worker_pool is not None:
+            main.worker_pool.set_threshold(chat_id, args.threshold)
+        game_logic.thresholds[chat_id] = args.threshold
+
+    # Everyone starts with a few Pokémon and some coins, so battles and pages have data
+    for user_id in users:
+        database.add_user(user_id, f"user{user_id}")
+    database.flush_writes()
+    for user_id in users:
+        for name in rng.sample(sorted(game_logic.pokedex.species_by_name), 8):
+            database.add_pokemon(user_id, name)
+        database.update_pokecoins(user_id, 500)
+    database.add_pokemon_to_user(users[0], "chikorita")  # Not bundled, /stats goes to PokeAPI
+    database.flush_writes()
+
+    # Group chatter, with catch races whenever something spawns
+    seen = len(client.sent)
+    races = []
+
+    async def chatter(chat_id, user_id, text):
+        nonlocal seen
+        await recorder.timed("group_message", client, fake_telethon.MessageEvent(chat_id, user_id, text))
+        while seen < len(client.sent):
+            method, sent_chat, caption, file = client.sent[seen]
+            seen += 1
+            if method == "send_file" and SPAWN_CAPTION in (caption or ""):
+                name = spawned_name(main, file)
+                if name:
+                    races.append(asyncio.ensure_future(catch_race(sent_chat, name)))
+
+    async def catch_race(chat_id, name):
+        catchers = rng.sample(users, min(args.catchers, len(users)))
+        await asyncio.gather(*(
+            recorder.timed("catch_attempt", client, fake_telethon.MessageEvent(chat_id, user_id, name.replace("-", " ").title()))
+            for user_id in catchers
+        ))
+
+    start = time.perf_counter()
+    await bounded([chatter(rng.choice(chats), rng.choice(users), rng.choice(CHATTER)) for _ in range(args.messages)],
+                  args.concurrency)
+    await asyncio.gather(*races)
+    recorder.wall["group_message"] = recorder.wall["catch_attempt"] = time.perf_counter() - start
+
+    # /mycollection and paging through it
+    async def browse(user_id):
+        await recorder.timed("collection_page", client, fake_telethon.MessageEvent(user_id, user_id, "/mycollection"))
+        await recorder.timed("collection_page", client, fake_telethon.CallbackEvent(user_id, user_id, f"next_{user_id}"))
+
+    start = time.perf_counter()
+    await bounded([browse(rng.choice(users)) for _ in range(args.pages)], args.concurrency)
+    recorder.wall["collection_page"] = time.perf_counter() - start
+
+    # /stats, including a species that has to come from PokeAPI
+    start = time.perf_counter()
+    lookups = []
+    for _ in range(args.stats):
+        user_id = rng.choice(users)
+        owned = await main.get_collection(user_id)
+        name = rng.choice(sorted(owned)) if owned else "pikachu"
+        lookups.append(recorder.timed("stats", client, fake_telethon.MessageEvent(user_id, user_id, f"/stats {name}")))
+    lookups.append(recorder.timed("stats", client, fake_telethon.MessageEvent(users[0], users[0], "/stats chikorita")))
+    await bounded(lookups, args.concurrency)
+    recorder.wall["stats"] = time.perf_counter() - start
+
+    # Concurrent battles between distinct pairs, played to the end
+    async def play(challenger, opponent, chat_id):
+        await client.dispatch(fake_telethon.MessageEvent(chat_id, challenger, "/battle", reply_to_sender=opponent))
+        await recorder.timed("battle_accept", client,
+                             fake_telethon.CallbackEvent(opponent, opponent, f"accept_{challenger}_{opponent}"))
+        while battles.get(challenger) is not None:
+            await client.dispatch(fake_telethon.CallbackEvent(challenger, challenger, f"pick_{rng.choice(STAT_PICKS)}"))
+            await recorder.timed("battle_round", client,
+                                 fake_telethon.CallbackEvent(opponent, opponent, f"pick_{rng.choice(STAT_PICKS)}"))
+
+    players = rng.sample(users, min(len(users) // 2 * 2, args.battles * 2))
+    start = time.perf_counter()
+    await asyncio.gather(*(play(players[i], players[i + 1], rng.choice(chats)) for i in range(0, len(players), 2)))
+    recorder.wall["battle_round"] = recorder.wall["battle_accept"] = time.perf_counter() - start
+
+    await asyncio.gather(*list(outbox.workers.values()))  # Let queued messages go out before shutdown
+    database.flush_writes()
+
+
+def call_counts(prefix):
+    import metrics
+    counts = {}
+    with metrics.lock:
+        for (name, labels), histogram in metrics.histograms.items():
+            if name == prefix:
+                counts[":".join(str(label) for label in labels) or "all"] = histogram[2]
+    return dict(sorted(counts.items()))
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(current, previous):
+    """Prints how each scenario moved relative to an earlier result file."""
+    print(f"\n📊 Compared with {previous.get('commit')} ({previous.get('timestamp')})")
+    for scenario, now in current["scenarios"].items():
+        before = previous.get("scenarios", {}).get(scenario)
+        if not before:
+            continue
+        deltas = []
+        for key in ("throughput_per_s", "p50_ms", "p99_ms"):
+            if before.get(key):
+                deltas.append(f"{key} {(now[key] - before[key]) / before[key] * 100:+.1f}%")
+        print(f"  {scenario}: " + ", ".join(deltas))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--chats", type=int, default=20, help="group chats sending messages")
+    parser.add_argument("--users", type=int, default=200, help="distinct users")
+    parser.add_argument("--messages", type=int, default=5000, help="group messages to replay")
+    parser.add_argument("--threshold", type=int, default=25, help="messages per spawn in every chat")
+    parser.add_argument("--catchers", type=int, default=5, help="users racing to catch each spawn")
+    parser.add_argument("--pages", type=int, default=200, help="/mycollection views (each also pages forward once)")
+    parser.add_argument("--stats", type=int, default=200, help="/stats lookups")
+    parser.add_argument("--battles", type=int, default=20, help="battles played at the same time")
+    parser.add_argument("--concurrency", type=int, default=50, help="updates handled at once")
+    parser.add_argument("--workers", type=int, default=0, help="WORKER_PROCESSES for the run")
+    parser.add_argument("--telegram-latency", type=float, default=0.0, help="simulated seconds per Telegram request")
+    parser.add_argument("--telegram-limits", action="store_true",
+                        help="keep the outbox's real Telegram rate limits (the fake client never throttles)")
+    parser.add_argument("--api-latency", type=float, default=0.0, help="simulated seconds per PokeAPI request")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="where to write the JSON results (default: bench/results/<commit>-<time>.json)")
+    parser.add_argument("--compare", help="earlier results file to compare against")
+    args = parser.parse_args()
+
+    fake_telethon.install()
+    stub = PokeAPIStub(args.api_latency).start()
+    workdir = tempfile.mkdtemp(prefix="pokebench-")
+    os.chdir(workdir)  # Fresh database, snapshot and backups for every run
+
+    import config
+    import game_logic
+    import outbox
+    config.WORKER_PROCESSES = args.workers
+    if not args.telegram_limits:
+        outbox.GLOBAL_RATE = outbox.PRIVATE_RATE = outbox.GROUP_RATE = 1e9
+        outbox.global_bucket = outbox.TokenBucket(outbox.GLOBAL_RATE, outbox.GLOBAL_BURST)
+    game_logic.POKEAPI_URL = stub.base_url
+
+    recorder = Recorder()
+    fake_telethon.FakeClient.run_hook = lambda: replay(args, recorder)
+    started = time.perf_counter()
+    import main as bot_main  # Starts up, replays the traffic inside run_until_disconnected(), shuts down
+    elapsed = time.perf_counter() - started
+    stub.stop()
+    os.chdir(ROOT)
+    shutil.rmtree(workdir, ignore_errors=True)
+
+    sent = {}
+    for method, *_ in bot_main.bot.sent:
+        sent[method] = sent.get(method, 0) + 1
+
+    results = {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "args": {key: value for key, value in vars(args).items() if key not in ("output", "compare")},
+        "elapsed_s": round(elapsed, 3),
+        "scenarios": recorder.summary(),
+        "db_calls": call_counts("db_call_seconds"),
+        "pokeapi_requests": stub.requests,
+        "telegram_requests": dict(sorted(sent.items())),
+    }
+
+    print(f"\n🏁 {results['commit']}: {elapsed:.2f}s total")
+    for scenario, stats in results["scenarios"].items():
+        print(f"  {scenario:<16} n={stats['count']:<6} {stats['throughput_per_s']}/s  "
+              f"p50={stats['p50_ms']}ms p90={stats['p90_ms']}ms p99={stats['p99_ms']}ms")
+    print(f"  DB calls: {sum(results['db_calls'].values())}, PokeAPI requests: {stub.requests}, "
+          f"Telegram requests: {sum(sent.values())}")
+
+    output = args.output or os.path.join(ROOT, "bench", "results", f"{results['commit'] or 'local'}-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    output = os.path.join(ROOT, output) if not os.path.isabs(output) else output
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    print(f"📝 Results written to {output}")
+
+    if args.compare:
+        with open(os.path.join(ROOT, args.compare) if not os.path.isabs(args.compare) else args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""Builds or refreshes pokedex.json from PokeAPI.
+
+Usage: python build_pokedex.py [--limit 151] [--output pokedex.json]
+
+Every evolution is kept, including ones outside the bundled range (like
+Golbat into Crobat). Stats and artwork for those come from PokeAPI when
+they're needed, like for any species that isn't bundled.
+"""
+import argparse
+import time
+import requests
+from pokedex import POKEDEX_PATH, save_pokedex
+
+API_URL = "https://pokeapi.co/api/v2"
+
+
+def fetch_json(session, url):
+    """Fetches a PokeAPI resource, retrying a few times on failure."""
+    for attempt in range(3):
+        try:
+            response = session.get(url, timeout=10)
+            response.raise_for_status()
+            return response.json()
+        except requests.exceptions.RequestException as e:
+            print(f"⚠️ Attempt {attempt + 1}: {url} failed - {e}")
+            time.sleep(2)
+    raise SystemExit(f"❌ Giving up on {url}")
+
+
+def collect_evolutions(chain, evolutions):
+    """Walks an evolution chain and records every species' direct evolutions."""
+    name = chain["species"]["name"]
+    evolutions[name] = [evo["species"]["name"] for evo in chain["evolves_to"]]
+    for evo in chain["evolves_to"]:
+        collect_evolutions(evo, evolutions)
+
+
+def build(limit):
+    session = requests.Session()
+    species = []
+    evolutions = {}
+    seen_chains = set()
+
+    for poke_id in range(1, limit + 1):
+        data = fetch_json(session, f"{API_URL}/pokemon/{poke_id}")
+        stats = {stat["stat"]["name"]: stat["base_stat"] for stat in data["stats"]}
+        species.append({
+            "id": poke_id,
+            "name": data["name"],
+            "stats": [stats["hp"], stats["attack"], stats["defense"],
+                      stats["special-attack"], stats["special-defense"], stats["speed"]],
+            "image": data["sprites"]["other"]["official-artwork"]["front_default"],
+        })
+
+        species_data = fetch_json(session, f"{API_URL}/pokemon-species/{poke_id}")
+        chain_url = species_data["evolution_chain"]["url"]
+        if chain_url not in seen_chains:
+            seen_chains.add(chain_url)
+            collect_evolutions(fetch_json(session, chain_url)["chain"], evolutions)
+
+        print(f"🟢 {poke_id}/{limit} {data['name']}")
+
+    for entry in species:
+        entry["evolves_to"] = evolutions.get(entry["name"], [])
+
+    return species
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--limit", type=int, default=151, help="highest national dex number to include")
+    parser.add_argument("--output", default=POKEDEX_PATH, help="where to write the Pokédex")
+    args = parser.parse_args()
+
+    species = build(args.limit)
+    save_pokedex(species, args.output)
+    print(f"✅ Wrote {len(species)} Pokémon to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
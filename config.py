@@ -3,3 +3,6 @@ API_ID = 26918101  # Replace with your API ID from my.telegram.org
 API_HASH = "57d6680f6549e21aca4e93c7a4221d29"  # Replace with your API Hash
 DEFAULT_THRESHOLD = 100  # Default drop time for all groups
 BOT_OWNER_ID = 996392648
+SPAWN_QUEUE_DEPTH = 5  # Pre-rolled spawns kept ready to post
+SPAWN_TTL = 300  # Seconds a wild Pokémon stays catchable before it flees
+WORKER_PROCESSES = 0  # Group messages are handled by this many worker processes (0 = in the main process)
@@ -1,110 +1,434 @@
+import atexit
+import os
 import sqlite3
 import random
-import requests
-from config import DEFAULT_THRESHOLD
+import queue
+import threading
+import time
+import pokedex
+from datetime import datetime, timedelta, timezone
+import leaderboard
+from collections import Counter
+from contextlib import contextmanager
 
 # Database path
 DB_PATH = "pokemon_game.db"
 
+# Connection settings
+READER_POOL_SIZE = 4  # Read-only connections shared by all threads
+STATEMENT_CACHE_SIZE = 128  # Prepared statements kept per connection
+CONNECTION_PRAGMAS = (
+    "PRAGMA journal_mode = WAL",  # Readers never wait for the writer
+    "PRAGMA synchronous = NORMAL",  # Safe with WAL, skips an fsync per commit
+    "PRAGMA cache_size = -16000",  # ~16 MB page cache
+    "PRAGMA mmap_size = 134217728",  # Map up to 128 MB of the file
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA busy_timeout = 5000",
+)
+
+# Write-behind settings
+WRITE_BATCH_SIZE = 200  # Queued rows that force an immediate flush
+WRITE_FLUSH_INTERVAL = 2.0  # Seconds between background flushes
+
+# Adds to a user's stack of one Pokémon, creating it if needed
+ADD_TO_COLLECTION = """
+    INSERT INTO collection (user_id, pokemon, quantity) VALUES (?, ?, ?)
+    ON CONFLICT(user_id, pokemon) DO UPDATE SET quantity = quantity + excluded.quantity
+"""
+
 # Reward constants
 REWARD_FOR_WIN = 50  # Points for a clean win (e.g., 5-0)
 REWARD_FOR_CLOSE_WIN = 30  # Points for a close win (e.g., 3-2)
 REWARD_FOR_CLOSE_LOSS = 20  # Points for a close loss (e.g., 2-3)
 
-def get_db_connection():
-    """Returns a database connection and cursor."""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    return conn, cursor
 
-def init_db():
-    """Initialize the database tables if they don't exist."""
-    conn, cursor = get_db_connection()
-    cursor.executescript("""
-        CREATE TABLE IF NOT EXISTS users (
-            user_id INTEGER PRIMARY KEY, 
+class ConnectionManager:
+    """One long-lived writer connection plus a small pool of reader connections."""
+
+    def __init__(self, path, readers=READER_POOL_SIZE):
+        self.path = path
+        self.write_lock = threading.RLock()
+        self.write_conn = self._connect()
+        self.read_conns = queue.Queue()
+        for _ in range(readers):
+            self.read_conns.put(self._connect())
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False, cached_statements=STATEMENT_CACHE_SIZE)
+        for pragma in CONNECTION_PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    @contextmanager
+    def writer(self):
+        """Yields a cursor on the writer; commits on success, rolls back on error."""
+        with self.write_lock:
+            cursor = self.write_conn.cursor()
+            try:
+                yield cursor
+                self.write_conn.commit()
+            except BaseException:
+                self.write_conn.rollback()
+                raise
+            finally:
+                cursor.close()
+
+    @contextmanager
+    def reader(self):
+        """Yields a cursor on a pooled reader connection."""
+        conn = self.read_conns.get()
+        cursor = conn.cursor()
+        try:
+            yield cursor
+        finally:
+            cursor.close()
+            if conn.in_transaction:
+                conn.rollback()
+            self.read_conns.put(conn)
+
+    def close(self):
+        with self.write_lock:
+            self.write_conn.close()
+        while not self.read_conns.empty():
+            self.read_conns.get_nowait().close()
+
+
+manager = None
+manager_lock = threading.Lock()
+
+def get_manager():
+    """Returns the shared connection manager, opening it on first use."""
+    global manager
+    if manager is None:
+        with manager_lock:
+            if manager is None:
+                manager = ConnectionManager(DB_PATH)
+    return manager
+
+def db_writer():
+    """Context manager yielding a cursor that may write; commits when the block ends.
+
+    Queued write-behind rows are flushed first so every write sees them
+    (flush_writes also waits out a flush that's already under way).
+    """
+    flush_writes()
+    return get_manager().writer()
+
+def db_reader():
+    """Context manager yielding a read-only cursor from the pool."""
+    return get_manager().reader()
+
+def close_db():
+    """Flushes queued writes and closes every pooled connection (call on shutdown)."""
+    global manager
+    flush_stop.set()
+    flush_writes()
+    with manager_lock:
+        if manager is not None:
+            manager.close()
+            manager = None
+
+# Write-behind queue for the per-message writes (new users, group members and catches)
+known_users = set()  # User IDs already in the users table
+known_members = set()  # (chat_id, user_id) pairs already in the chat_members table
+pending_users = []  # (user_id, username) rows waiting to be inserted
+pending_members = []  # (chat_id, user_id) rows waiting to be inserted
+pending_catches = []  # (user_id, pokemon) catches waiting to be added
+pending_lock = threading.Lock()
+flush_lock = threading.Lock()  # Held from taking a batch until it's committed, so readers never miss it
+flush_stop = threading.Event()
+
+def _reset_after_fork():
+    """A forked worker process opens its own connections; the parent's are never touched."""
+    global manager, manager_lock, pending_lock, flush_lock
+    manager = None
+    manager_lock = threading.Lock()
+    pending_lock = threading.Lock()
+    flush_lock = threading.Lock()
+    pending_users.clear()
+    pending_members.clear()
+    pending_catches.clear()
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+def flush_writes():
+    """Writes every queued user, group member and catch in one transaction.
+
+    Returns only once everything queued before the call is committed, even if
+    another thread had already taken it, so a read right after sees it.
+    """
+    with flush_lock:
+        with pending_lock:
+            users, members, catches = pending_users[:], pending_members[:], pending_catches[:]
+            pending_users.clear()
+            pending_members.clear()
+            pending_catches.clear()
+
+        if not users and not members and not catches:
+            return
+
+        try:
+            with get_manager().writer() as cursor:
+                if users:
+                    cursor.executemany("INSERT OR IGNORE INTO users (user_id, username, pokecoins) VALUES (?, ?, 0)", users)
+                if members:
+                    cursor.executemany("INSERT OR IGNORE INTO chat_members (chat_id, user_id) VALUES (?, ?)", members)
+                if catches:
+                    counts = Counter(catches)  # One upsert per (user, Pokémon) in the batch
+                    cursor.executemany(ADD_TO_COLLECTION, [(user_id, pokemon, n) for (user_id, pokemon), n in counts.items()])
+        except sqlite3.Error as e:
+            print(f"Database Error: {e}")
+            with pending_lock:  # Put them back for the next attempt
+                pending_users[:0] = users
+                pending_members[:0] = members
+                pending_catches[:0] = catches
+            return
+
+        # Scores only change once the catches are committed
+        if catches:
+            for (user_id, pokemon), n in counts.items():
+                leaderboard.add_catch(user_id, pokemon, n)
+
+def _flush_loop():
+    while not flush_stop.wait(WRITE_FLUSH_INTERVAL):
+        flush_writes()
+
+def start_write_behind():
+    """Loads known users and starts the background flusher."""
+    with db_reader() as cursor:
+        cursor.execute("SELECT user_id FROM users")
+        known_users.update(row[0] for row in cursor.fetchall())
+        cursor.execute("SELECT chat_id, user_id FROM chat_members")
+        known_members.update(cursor.fetchall())
+
+    flush_stop.clear()
+    threading.Thread(target=_flush_loop, name="db-flush", daemon=True).start()
+    atexit.register(flush_writes)
+
+def migrate_catches(cursor):
+    """Moves the old one-row-per-catch table (if any) into per-species counts."""
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'catches'")
+    if not cursor.fetchone():
+        return
+
+    cursor.execute("""
+        INSERT INTO collection (user_id, pokemon, quantity)
+        SELECT user_id, pokemon, COUNT(*) FROM catches WHERE true GROUP BY user_id, pokemon
+        ON CONFLICT(user_id, pokemon) DO UPDATE SET quantity = quantity + excluded.quantity
+    """)
+    print(f"🟢 Migrated {cursor.rowcount} collection stacks from the catches table")
+    cursor.execute("DROP TABLE catches")
+
+# Schema migrations, applied in order. PRAGMA user_version holds the last one applied.
+# Each step is a SQL statement or a function taking a cursor. Never edit a released
+# migration, append a new one instead.
+MIGRATIONS = [
+    (1, "base tables", [
+        """CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
             username TEXT,
             doj TEXT DEFAULT (DATE('now')),
             battle_wins INTEGER DEFAULT 0,
             pokecoins INTEGER DEFAULT 0
-        );
-        CREATE TABLE IF NOT EXISTS catches (
-            user_id INTEGER, 
-            pokemon TEXT,
-            FOREIGN KEY (user_id) REFERENCES users(user_id)
-        );
-        CREATE TABLE IF NOT EXISTS drop_time (
+        )""",
+        """CREATE TABLE IF NOT EXISTS drop_time (
             chat_id INTEGER PRIMARY KEY,
             threshold INTEGER DEFAULT 100
-        );
-    """)
-    conn.commit()
-    conn.close()
+        )""",
+        """CREATE TABLE IF NOT EXISTS shop (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            pokemon TEXT,
+            price INTEGER,
+            date TEXT DEFAULT (DATE('now'))
+        )""",
+        """CREATE TABLE IF NOT EXISTS purchases (
+            user_id INTEGER,
+            pokemon TEXT,
+            date TEXT DEFAULT (DATE('now')),
+            PRIMARY KEY (user_id, pokemon, date)
+        )""",
+    ]),
+    (2, "PokeAPI and Telegram media caches", [
+        """CREATE TABLE IF NOT EXISTS media_cache (
+            pokemon TEXT PRIMARY KEY,
+            photo_id INTEGER,
+            access_hash INTEGER,
+            file_reference BLOB
+        )""",
+        """CREATE TABLE IF NOT EXISTS api_cache (
+            url TEXT PRIMARY KEY,
+            status INTEGER,
+            body TEXT,
+            expires_at REAL
+        )""",
+    ]),
+    (3, "per-species collection counts", [
+        """CREATE TABLE IF NOT EXISTS collection (
+            user_id INTEGER,
+            pokemon TEXT,
+            quantity INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, pokemon),
+            FOREIGN KEY (user_id) REFERENCES users(user_id)
+        ) WITHOUT ROWID""",
+        migrate_catches,
+    ]),
+    (4, "shop indexes", [
+        # Covers the daily lookups (by date, and by date + Pokémon for purchases)
+        "CREATE INDEX IF NOT EXISTS idx_shop_date ON shop (date, pokemon, price)",
+    ]),
+    (5, "group members for per-group leaderboards", [
+        """CREATE TABLE IF NOT EXISTS chat_members (
+            chat_id INTEGER,
+            user_id INTEGER,
+            PRIMARY KEY (chat_id, user_id)
+        ) WITHOUT ROWID""",
+    ]),
+]
+
+# Queries on the hot paths, each must be answered through an index
+HOT_QUERIES = [
+    ("get_collection", "SELECT pokemon, quantity FROM collection WHERE user_id = ? AND quantity > 0", (1,)),
+    ("get_collection_page", "SELECT pokemon, quantity FROM collection WHERE user_id = ? AND quantity > 0 ORDER BY pokemon LIMIT ? OFFSET ?", (1, 10, 0)),
+    ("get_pokemon_count", "SELECT quantity FROM collection WHERE user_id = ? AND pokemon = ?", (1, "pikachu")),
+    ("get_user_stats", "SELECT COALESCE(SUM(quantity), 0) FROM collection WHERE user_id = ?", (1,)),
+    ("evolve_pokemon", "UPDATE collection SET quantity = quantity - 1 WHERE user_id = ? AND pokemon = ? AND quantity > 0", (1, "pikachu")),
+    ("buy_pokemon purchase check", "SELECT 1 FROM purchases WHERE user_id = ? AND pokemon = ? AND date = DATE('now')", (1, "pikachu")),
+    ("stock_shop", "SELECT pokemon, price FROM shop WHERE date = ?", ("2024-01-01",)),
+    ("get_pokecoins", "SELECT pokecoins FROM users WHERE user_id = ?", (1,)),
+]
+
+def migrate(cursor):
+    """Applies every migration newer than the database's user_version."""
+    cursor.execute("PRAGMA user_version")
+    current = cursor.fetchone()[0]
+
+    for version, description, steps in MIGRATIONS:
+        if version <= current:
+            continue
+
+        cursor.execute("BEGIN")
+        for step in steps:
+            if callable(step):
+                step(cursor)
+            else:
+                cursor.execute(step)
+        cursor.execute(f"PRAGMA user_version = {version}")
+        cursor.connection.commit()
+        print(f"🟢 Applied database migration {version}: {description}")
+
+def check_query_plans():
+    """Returns a description of every HOT_QUERIES entry that needs a full table scan."""
+    problems = []
+    with db_reader() as cursor:
+        for name, sql, params in HOT_QUERIES:
+            cursor.execute(f"EXPLAIN QUERY PLAN {sql}", params)
+            scans = [row[-1] for row in cursor.fetchall() if row[-1].startswith("SCAN")]
+            if scans:
+                problems.append(f"{name} does a full scan: {'; '.join(scans)}")
+    return problems
+
+def init_db():
+    """Brings the database schema up to date and warns if a hot query stopped using its index."""
+    with db_writer() as cursor:
+        migrate(cursor)
+    # Only a warning: a SQLite upgrade that changes a plan must not keep the bot from starting
+    for problem in check_query_plans():
+        print(f"⚠️ Query plan check: {problem}")
 
 def get_user_stats(user_id):
     """Retrieve user stats: username, DOJ, battle wins, and Pokémon count."""
-    conn, cursor = get_db_connection()
-    cursor.execute("SELECT username, doj, battle_wins FROM users WHERE user_id = ?", (user_id,))
-    user_data = cursor.fetchone()
-    
-    cursor.execute("SELECT COUNT(*) FROM catches WHERE user_id = ?", (user_id,))
-    pokemon_count = cursor.fetchone()[0]
-
-    conn.close()
-    
+    flush_writes()
+    with db_reader() as cursor:
+        cursor.execute("SELECT username, doj, battle_wins FROM users WHERE user_id = ?", (user_id,))
+        user_data = cursor.fetchone()
+
+        cursor.execute("SELECT COALESCE(SUM(quantity), 0) FROM collection WHERE user_id = ?", (user_id,))
+        pokemon_count = cursor.fetchone()[0]
+
     if user_data:
         username, doj, battle_wins = user_data
         return username, doj, battle_wins, pokemon_count
     return None
 
 def add_user(user_id, username):
-    """Adds a user if they don't already exist."""
-    conn, cursor = get_db_connection()
-    try:
-        cursor.execute("INSERT OR IGNORE INTO users (user_id, username, pokecoins) VALUES (?, ?, 0)", (user_id, username))
-        conn.commit()
-    except sqlite3.Error as e:
-        print(f"Database Error: {e}")
-    finally:
-        conn.close()
+    """Adds a user if they don't already exist (queued, no I/O for known users)."""
+    if user_id in known_users:
+        return
+
+    known_users.add(user_id)
+    leaderboard.add_user(user_id, username)
+    with pending_lock:
+        pending_users.append((user_id, username))
+        full = len(pending_users) >= WRITE_BATCH_SIZE
+    if full:
+        flush_writes()
+
+def add_chat_member(chat_id, user_id):
+    """Remembers that a user talks in a group (queued, no I/O for known members)."""
+    if (chat_id, user_id) in known_members:
+        return
+
+    known_members.add((chat_id, user_id))
+    leaderboard.add_member(chat_id, user_id)
+    with pending_lock:
+        pending_members.append((chat_id, user_id))
+        full = len(pending_members) >= WRITE_BATCH_SIZE
+    if full:
+        flush_writes()
 
 def add_pokemon(user_id, pokemon):
-    """Adds a caught Pokémon to the user's collection."""
-    conn, cursor = get_db_connection()
-    try:
-        cursor.execute("INSERT INTO catches (user_id, pokemon) VALUES (?, ?)", (user_id, pokemon))
-        conn.commit()
-    except sqlite3.Error as e:
-        print(f"Database Error: {e}")
-    finally:
-        conn.close()
+    """Adds a caught Pokémon to the user's collection (queued and written in batches)."""
+    with pending_lock:
+        pending_catches.append((user_id, pokemon))
+        full = len(pending_catches) >= WRITE_BATCH_SIZE
+    if full:
+        flush_writes()
 
 def get_collection(user_id):
-    """Retrieves the list of Pokémon a user has caught."""
-    conn, cursor = get_db_connection()
-    cursor.execute("SELECT pokemon FROM catches WHERE user_id = ?", (user_id,))
-    pokes = [poke[0] for poke in cursor.fetchall()]
-    conn.close()
-    return pokes
+    """Retrieves the Pokémon a user has caught as {pokemon: quantity}."""
+    flush_writes()
+    with db_reader() as cursor:
+        cursor.execute("SELECT pokemon, quantity FROM collection WHERE user_id = ? AND quantity > 0", (user_id,))
+        return dict(cursor.fetchall())
+
+def get_collection_page(user_id, page, per_page):
+    """Returns one alphabetical page of a user's collection as ([(pokemon, quantity)], total species)."""
+    flush_writes()
+    with db_reader() as cursor:
+        cursor.execute("SELECT COUNT(*) FROM collection WHERE user_id = ? AND quantity > 0", (user_id,))
+        total = cursor.fetchone()[0]
+
+        cursor.execute("SELECT pokemon, quantity FROM collection WHERE user_id = ? AND quantity > 0 ORDER BY pokemon LIMIT ? OFFSET ?",
+                       (user_id, per_page, page * per_page))
+        return cursor.fetchall(), total
+
+def get_pokemon_count(user_id, pokemon):
+    """Returns how many of one Pokémon a user owns."""
+    flush_writes()
+    with db_reader() as cursor:
+        cursor.execute("SELECT quantity FROM collection WHERE user_id = ? AND pokemon = ?", (user_id, pokemon))
+        result = cursor.fetchone()
+    return result[0] if result else 0
 
 def get_pokecoins(user_id):
     """Retrieves the amount of PokéCoins a user has."""
-    conn, cursor = get_db_connection()
-    cursor.execute("SELECT pokecoins FROM users WHERE user_id = ?", (user_id,))
-    result = cursor.fetchone()
-    conn.close()
+    flush_writes()
+    with db_reader() as cursor:
+        cursor.execute("SELECT pokecoins FROM users WHERE user_id = ?", (user_id,))
+        result = cursor.fetchone()
     return result[0] if result else 0
 
 def update_pokecoins(user_id, amount):
     """Updates the user's PokéCoins balance by adding or subtracting the given amount."""
-    conn, cursor = get_db_connection()
     try:
-        cursor.execute("UPDATE users SET pokecoins = pokecoins + ? WHERE user_id = ?", (amount, user_id))
-        conn.commit()
+        with db_writer() as cursor:
+            cursor.execute("UPDATE users SET pokecoins = pokecoins + ? WHERE user_id = ?", (amount, user_id))
+            updated = cursor.rowcount
     except sqlite3.Error as e:
         print(f"Database Error: {e}")
-    finally:
-        conn.close()
+        return
+    if updated:
+        leaderboard.add_pokecoins(user_id, amount)
 
 def calculate_rewards(winner_score, loser_score):
     """
@@ -120,7 +444,7 @@ def calculate_rewards(winner_score, loser_score):
 
 def distribute_rewards(winner_id, loser_id, winner_score, loser_score):
     """Distributes rewards and updates battle wins for the winner."""
-    
+
     winner_reward, loser_reward = calculate_rewards(winner_score, loser_score)
 
     # Update battle wins for the winner
@@ -135,170 +459,202 @@ def distribute_rewards(winner_id, loser_id, winner_score, loser_score):
 
 def update_battle_wins(user_id):
     """Increments the battle wins count for a user."""
-    conn, cursor = get_db_connection()
-    cursor.execute("UPDATE users SET battle_wins = battle_wins + 1 WHERE user_id = ?", (user_id,))
-    conn.commit()
-    conn.close()
+    with db_writer() as cursor:
+        cursor.execute("UPDATE users SET battle_wins = battle_wins + 1 WHERE user_id = ?", (user_id,))
+        updated = cursor.rowcount
+    if updated:
+        leaderboard.add_battle_win(user_id)
 
 
 
 def evolve_pokemon(user_id, current_pokemon, evolved_pokemon):
     """Replaces a Pokémon in the user's collection with its evolved form."""
-    conn, cursor = get_db_connection()
-
     try:
-        cursor.execute("SELECT rowid FROM catches WHERE user_id = ? AND pokemon = ? LIMIT 1", (user_id, current_pokemon))
-        row = cursor.fetchone()
-
-        if row:
-            cursor.execute("DELETE FROM catches WHERE rowid = ?", (row[0],))
-            cursor.execute("INSERT INTO catches (user_id, pokemon) VALUES (?, ?)", (user_id, evolved_pokemon))
-            conn.commit()
+        with db_writer() as cursor:
+            cursor.execute("UPDATE collection SET quantity = quantity - 1 WHERE user_id = ? AND pokemon = ? AND quantity > 0",
+                           (user_id, current_pokemon))
+
+            if not cursor.rowcount:
+                return
+            cursor.execute("DELETE FROM collection WHERE user_id = ? AND pokemon = ? AND quantity = 0", (user_id, current_pokemon))
+            none_left = cursor.rowcount > 0
+            cursor.execute(ADD_TO_COLLECTION, (user_id, evolved_pokemon, 1))
             print(f"🟢 {current_pokemon} evolved into {evolved_pokemon} for user {user_id}")  # Debug message
     except Exception as e:
         print(f"🔴 Database Error: {e}")  # Debug error
-    finally:
-        conn.close()
-        print("🟢 Database connection closed.")  # Debug: Ensure DB closes
-
-
-def setup_shop():
-    """Creates the shop and purchases tables if they don't exist."""
-    conn, cursor = get_db_connection()
-    cursor.executescript("""
-        CREATE TABLE IF NOT EXISTS shop (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            pokemon TEXT,
-            price INTEGER,
-            date TEXT DEFAULT (DATE('now'))
-        );
-
-        CREATE TABLE IF NOT EXISTS purchases (
-            user_id INTEGER,
-            pokemon TEXT,
-            date TEXT DEFAULT (DATE('now')),
-            PRIMARY KEY (user_id, pokemon, date)
-        );
-    """)
-    conn.commit()
-    conn.close()
-
-
-
-
-
-def refresh_shop():
-    """Generates a new set of Pokémon for the daily shop."""
-    conn, cursor = get_db_connection()
-
-    # Check if the shop already has Pokémon for today
-    cursor.execute("SELECT 1 FROM shop WHERE date = DATE('now')")
-    if cursor.fetchone():
-        conn.close()
-        return  # Shop is already set for today
-
-    # Clear old shop entries
-    cursor.execute("DELETE FROM shop WHERE date != DATE('now')")
-
-    # Get 5 random Pokémon (limit to 151 for now)
-    random_pokemon = random.sample(range(1, 151), 5)
-
-    # Insert new Pokémon with random prices (50-200 PokéCoins)
-    for poke_id in random_pokemon:
-        response = requests.get(f"https://pokeapi.co/api/v2/pokemon/{poke_id}")
-        if response.status_code == 200:
-            pokemon_name = response.json()["name"]
-            price = random.randint(50, 200)
-            cursor.execute("INSERT INTO shop (pokemon, price) VALUES (?, ?)", (pokemon_name, price))
-
-    conn.commit()
-    conn.close()
+        return
+
+    leaderboard.remove_pokemon(user_id, current_pokemon, none_left)
+    leaderboard.add_catch(user_id, evolved_pokemon)
+
+
+# Daily shop, kept in memory for today and tomorrow so /shop and buys never rebuild it
+SHOP_SIZE = 5
+SHOP_PRICES = (50, 200)  # PokéCoins, inclusive
+shop_catalogue = {}  # "YYYY-MM-DD" -> {pokemon: price}
+
+def shop_date(days_ahead=0):
+    """The shop's date, in UTC like SQLite's DATE('now') that purchases are stamped with."""
+    return (datetime.now(timezone.utc) + timedelta(days=days_ahead)).date().isoformat()
+
+def stock_shop(date=None):
+    """Returns the shop for a date, generating and saving it in one transaction if it's missing."""
+    date = date or shop_date()
+    with db_writer() as cursor:
+        cursor.execute("SELECT pokemon, price FROM shop WHERE date = ?", (date,))
+        items = dict(cursor.fetchall())
+        if not items:
+            items = {name: random.randint(*SHOP_PRICES) for name in pokedex.sample_names(SHOP_SIZE)}
+            cursor.executemany("INSERT INTO shop (pokemon, price, date) VALUES (?, ?, ?)",
+                               [(name, price, date) for name, price in items.items()])
+
+    shop_catalogue[date] = items
+    return items
+
+def prune_shop():
+    """Drops shops from past days, in memory and in the database (future ones are kept)."""
+    today = shop_date()
+    for date in [date for date in shop_catalogue if date < today]:
+        del shop_catalogue[date]
+    with db_writer() as cursor:
+        cursor.execute("DELETE FROM shop WHERE date < ?", (today,))
+
+def get_shop_items():
+    """Returns today's shop as (pokemon, price) rows."""
+    items = shop_catalogue.get(shop_date())
+    if items is None:
+        items = stock_shop()
+    return list(items.items())
 
 
 def buy_pokemon(user_id, pokemon_name):
     """Handles purchasing Pokémon if the user has enough coins and hasn't bought it today."""
-    conn, cursor = get_db_connection()
-
-    # Check if Pokémon is in the shop today
-    cursor.execute("SELECT price FROM shop WHERE pokemon = ? AND date = DATE('now')", (pokemon_name,))
-    shop_entry = cursor.fetchone()
-
-    if not shop_entry:
-        conn.close()
+    # Check if Pokémon is in the shop today (from memory)
+    price = dict(get_shop_items()).get(pokemon_name)
+    if price is None:
         return "❌ This Pokémon is not available in today's shop!"
 
-    price = shop_entry[0]
-
-    # Check user's PokéCoins balance
-    cursor.execute("SELECT pokecoins FROM users WHERE user_id = ?", (user_id,))
-    user_coins = cursor.fetchone()[0]
+    with db_writer() as cursor:
+        # Check user's PokéCoins balance
+        cursor.execute("SELECT pokecoins FROM users WHERE user_id = ?", (user_id,))
+        user_coins = cursor.fetchone()[0]
 
-    if user_coins < price:
-        conn.close()
-        return "❌ You don't have enough PokéCoins to buy this Pokémon!"
+        if user_coins < price:
+            return "❌ You don't have enough PokéCoins to buy this Pokémon!"
 
-    # Check if user already purchased this Pokémon today
-    cursor.execute("SELECT 1 FROM purchases WHERE user_id = ? AND pokemon = ? AND date = DATE('now')", (user_id, pokemon_name))
-    if cursor.fetchone():
-        conn.close()
-        return "❌ You have already purchased this Pokémon today!"
+        # Check if user already purchased this Pokémon today
+        cursor.execute("SELECT 1 FROM purchases WHERE user_id = ? AND pokemon = ? AND date = DATE('now')", (user_id, pokemon_name))
+        if cursor.fetchone():
+            return "❌ You have already purchased this Pokémon today!"
 
-    # Deduct PokéCoins and add Pokémon to user's collection
-    cursor.execute("UPDATE users SET pokecoins = pokecoins - ? WHERE user_id = ?", (price, user_id))
-    cursor.execute("INSERT INTO purchases (user_id, pokemon) VALUES (?, ?)", (user_id, pokemon_name))
-    cursor.execute("INSERT INTO catches (user_id, pokemon) VALUES (?, ?)", (user_id, pokemon_name))
+        # Deduct PokéCoins and add Pokémon to user's collection
+        cursor.execute("UPDATE users SET pokecoins = pokecoins - ? WHERE user_id = ?", (price, user_id))
+        cursor.execute("INSERT INTO purchases (user_id, pokemon) VALUES (?, ?)", (user_id, pokemon_name))
+        cursor.execute(ADD_TO_COLLECTION, (user_id, pokemon_name, 1))
 
-    conn.commit()
-    conn.close()
+    leaderboard.add_pokecoins(user_id, -price)
+    leaderboard.add_catch(user_id, pokemon_name)
     return f"✅ You successfully bought {pokemon_name.capitalize()} for {price} PokéCoins!"
 
 def add_resource(user_id, resource, amount):
     """Adds PokéCoins to a specific user."""
-    conn, cursor = get_db_connection()
+    if resource != "pokecoins":
+        return f"❌ Invalid resource: {resource}"
 
-    if resource == "pokecoins":
+    with db_writer() as cursor:
         cursor.execute("UPDATE users SET pokecoins = pokecoins + ? WHERE user_id = ?", (amount, user_id))
-    else:
-        conn.close()
-        return f"❌ Invalid resource: {resource}"
+        updated = cursor.rowcount
 
-    conn.commit()
-    conn.close()
+    if updated:
+        leaderboard.add_pokecoins(user_id, amount)
     return f"✅ Successfully added {amount} {resource.capitalize()} to user {user_id}!"
 
 
 def add_pokemon_to_user(user_id, pokemon_name):
     """Adds a Pokémon to the user's collection and ensures the database is updated properly."""
-    conn, cursor = get_db_connection()
     try:
         print(f"🟢 Attempting to add {pokemon_name.capitalize()} to User {user_id}")  # Debug log
-        cursor.execute("INSERT INTO catches (user_id, pokemon) VALUES (?, ?)", (user_id, pokemon_name))
-        conn.commit()
+        with db_writer() as cursor:
+            cursor.execute(ADD_TO_COLLECTION, (user_id, pokemon_name, 1))
+        leaderboard.add_catch(user_id, pokemon_name)
         print(f"✅ {pokemon_name.capitalize()} successfully added to User {user_id}")  # Debug log
         return f"✅ Successfully added {pokemon_name.capitalize()} to user {user_id}!"
     except sqlite3.Error as e:
         print(f"🔴 Database Error: {e}")  # Debug log
         return f"❌ Database Error: {e}"
-    finally:
-        conn.close()
-
-# ✅ Fetch Drop Time from DB
-def get_drop_time(chat_id):
-    """Retrieves the Pokémon spawn threshold for a specific chat."""
-    conn, cursor = get_db_connection()
-    cursor.execute("SELECT threshold FROM drop_time WHERE chat_id = ?", (chat_id,))
-    result = cursor.fetchone()
-    conn.close()
-    return result[0] if result else DEFAULT_THRESHOLD  # Default to 100 if not set
+
+def load_leaderboards():
+    """Rebuilds the in-memory leaderboards from the database (once, at startup)."""
+    flush_writes()
+    with db_reader() as cursor:
+        cursor.execute("SELECT user_id, username, pokecoins, battle_wins FROM users")
+        users = cursor.fetchall()
+        cursor.execute("SELECT user_id, pokemon, quantity FROM collection WHERE quantity > 0")
+        collection = cursor.fetchall()
+        cursor.execute("SELECT chat_id, user_id FROM chat_members")
+        memberships = cursor.fetchall()
+    leaderboard.rebuild(users, collection, memberships)
+
+# ✅ Fetch Drop Times from DB
+def get_drop_times():
+    """Returns every chat's Pokémon spawn threshold as {chat_id: threshold}."""
+    with db_reader() as cursor:
+        cursor.execute("SELECT chat_id, threshold FROM drop_time")
+        return dict(cursor.fetchall())
 
 # ✅ Set Drop Time in DB
 def set_drop_time(chat_id, threshold):
     """Updates or inserts the Pokémon spawn threshold for a specific chat."""
-    conn, cursor = get_db_connection()
-    cursor.execute("""
-        INSERT INTO drop_time (chat_id, threshold)
-        VALUES (?, ?)
-        ON CONFLICT(chat_id) DO UPDATE SET threshold = excluded.threshold;
-    """, (chat_id, threshold))
-    conn.commit()
-    conn.close()
+    with db_writer() as cursor:
+        cursor.execute("""
+            INSERT INTO drop_time (chat_id, threshold)
+            VALUES (?, ?)
+            ON CONFLICT(chat_id) DO UPDATE SET threshold = excluded.threshold;
+        """, (chat_id, threshold))
+
+# ✅ PokeAPI response cache
+def get_cached_response(url):
+    """Returns (status, body, expires_at) for a cached PokeAPI URL, or None if it isn't cached."""
+    with db_reader() as cursor:
+        cursor.execute("SELECT status, body, expires_at FROM api_cache WHERE url = ?", (url,))
+        return cursor.fetchone()
+
+def store_cached_response(url, status, body, expires_at):
+    """Stores a PokeAPI response (body is None for a cached 404)."""
+    try:
+        with db_writer() as cursor:
+            cursor.execute("INSERT OR REPLACE INTO api_cache (url, status, body, expires_at) VALUES (?, ?, ?, ?)",
+                           (url, status, body, expires_at))
+    except sqlite3.Error as e:
+        print(f"Database Error: {e}")
+
+def prune_cached_responses():
+    """Deletes expired PokeAPI responses. Returns how many were removed."""
+    try:
+        with db_writer() as cursor:
+            cursor.execute("DELETE FROM api_cache WHERE expires_at <= ?", (time.time(),))
+            return cursor.rowcount
+    except sqlite3.Error as e:
+        print(f"Database Error: {e}")
+        return 0
+
+# ✅ Telegram media cache
+def get_media_refs():
+    """Returns every cached artwork upload as (pokemon, photo_id, access_hash, file_reference) rows."""
+    with db_reader() as cursor:
+        cursor.execute("SELECT pokemon, photo_id, access_hash, file_reference FROM media_cache")
+        return cursor.fetchall()
+
+def set_media_ref(pokemon, photo_id, access_hash, file_reference):
+    """Remembers the uploaded Telegram photo for a Pokémon's artwork."""
+    try:
+        with db_writer() as cursor:
+            cursor.execute("INSERT OR REPLACE INTO media_cache (pokemon, photo_id, access_hash, file_reference) VALUES (?, ?, ?, ?)",
+                           (pokemon, photo_id, access_hash, file_reference))
+    except sqlite3.Error as e:
+        print(f"Database Error: {e}")
+
+def delete_media_ref(pokemon):
+    """Forgets a Pokémon's uploaded photo, e.g. after Telegram rejected it."""
+    with db_writer() as cursor:
+        cursor.execute("DELETE FROM media_cache WHERE pokemon = ?", (pokemon,))
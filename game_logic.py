@@ -1,43 +1,250 @@
+import asyncio
+import json
+import os
+import re
+import time
 import requests
 import random
-from config import DEFAULT_THRESHOLD
-from database import get_drop_time 
-import time 
+import pokedex
+import metrics
+import stat_matrix
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from config import DEFAULT_THRESHOLD, SPAWN_QUEUE_DEPTH, SPAWN_TTL
+from collections import OrderedDict
+import async_db
+from database import get_drop_times, get_cached_response, store_cached_response, prune_cached_responses
 
 message_counts = {}  # Track message counts per chat
-thresholds = {}  # Store drop time per group (defaults to DEFAULT_THRESHOLD)
+thresholds = {}  # Drop time per group, loaded from the drop_time table (defaults to DEFAULT_THRESHOLD)
 
-current_pokemon = {}  # Track spawned Pokémon per chat
+current_pokemon = {}  # Chat ID -> live spawn {"name", "image", "key", "expires"}; chats without one have no entry
+spawn_queue = None  # Pre-rolled spawns, filled by spawn_producer()
 
-def get_random_pokemon():
-    poke_id = random.randint(1, 151)  # Limit to Gen 1
-    url = f"https://pokeapi.co/api/v2/pokemon/{poke_id}"
+# Spawn expiry wheel: spawns are filed under the tick they expire in, and each
+# tick of the sweeper only looks at the buckets that came due
+SPAWN_TICK = 5  # Seconds per bucket
+spawn_wheel = {}  # Tick number -> chat IDs whose spawn expires in that tick
 
-    for attempt in range(3):  # Retry up to 3 times
-        try:
-            response = requests.get(url, timeout=5)
-            response.raise_for_status()  # Raise error for bad responses (e.g., 404, 500)
+NAME_ALIASES = str.maketrans({"♀": "f", "♂": "m"})
+NON_NAME_CHARS = re.compile(r"[^a-z0-9]")
+MAX_NAME_LENGTH = 32  # Longer messages can't be a Pokémon name
+
+metrics.describe("spawns_total", "counter", "Wild Pokémon spawned")
+metrics.describe("catches_total", "counter", "Wild Pokémon caught")
+metrics.describe("spawns_fled_total", "counter", "Wild Pokémon that fled uncaught")
+
+# PokeAPI client settings
+POKEAPI_URL = "https://pokeapi.co/api/v2"
+MAX_API_REQUESTS = 4  # Concurrent PokeAPI requests (also the keep-alive pool size)
+API_TIMEOUT = 5  # Seconds per request
+API_RETRIES = 3
+
+# Shared keep-alive session, only ever used from the API worker threads
+http_session = requests.Session()
+http_session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=MAX_API_REQUESTS))
+http_session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=MAX_API_REQUESTS))
+api_executor = ThreadPoolExecutor(max_workers=MAX_API_REQUESTS, thread_name_prefix="pokeapi")
+
+api_semaphore = None  # Caps PokeAPI calls in flight; made by _fetch_with_retries inside the bot's (or a worker's) loop
+in_flight = {}  # URL -> task, so concurrent lookups of the same species share one request
+
+# PokeAPI response cache: in-memory LRU in front of the api_cache table
+CACHE_SIZE = 512  # Responses kept in memory
+CACHE_TTLS = {  # Seconds a successful response stays fresh, per endpoint
+    "pokemon": 7 * 24 * 3600,
+    "pokemon-species": 7 * 24 * 3600,
+    "evolution-chain": 30 * 24 * 3600,
+}
+DEFAULT_CACHE_TTL = 24 * 3600
+NEGATIVE_CACHE_TTL = 6 * 3600  # How long a 404 is remembered
+CACHE_PRUNE_INTERVAL = 6 * 3600  # Seconds between sweeps of expired api_cache rows
+
+response_cache = OrderedDict()  # URL -> (data or None for 404, expires_at)
+cache_stats = {"memory_hits": 0, "disk_hits": 0, "negative_hits": 0, "misses": 0}
+
+
+def cache_ttl(url, status):
+    """Returns how long a response for this URL should be cached."""
+    if status == 404:
+        return NEGATIVE_CACHE_TTL
+    endpoint = url.split("/api/v2/", 1)[-1].split("/", 1)[0]
+    return CACHE_TTLS.get(endpoint, DEFAULT_CACHE_TTL)
+
+
+def _remember(url, data, expires_at):
+    response_cache[url] = (data, expires_at)
+    response_cache.move_to_end(url)
+    if len(response_cache) > CACHE_SIZE:
+        response_cache.popitem(last=False)  # Drop the least recently used
 
-            data = response.json()
-            return {
-                "name": data["name"],
-                "image": data["sprites"]["other"]["official-artwork"]["front_default"]
-            }
 
+def _cached_in_memory(url):
+    """Returns (True, data) for a fresh in-memory entry, else (False, None)."""
+    cached = response_cache.get(url)
+    if cached is None:
+        return False, None
+    if cached[1] <= time.time():
+        del response_cache[url]
+        return False, None
+    response_cache.move_to_end(url)
+    return True, cached[0]
+
+
+def _load_from_disk(url):
+    """Reads a fresh cache row, run on the DB threads. Returns (found, data, expires_at)."""
+    row = get_cached_response(url)
+    if not row or row[2] <= time.time():
+        return False, None, 0
+    status, body, expires_at = row
+    return True, (json.loads(body) if status == 200 else None), expires_at
+
+
+def _store_on_disk(url, status, data, expires_at):
+    body = json.dumps(data, separators=(",", ":")) if data is not None else None
+    store_cached_response(url, status, body, expires_at)
+
+
+metrics.describe("pokeapi_request", "histogram", "PokeAPI requests", ["status"])
+
+
+def _http_get(url):
+    """Blocking GET, run on the API thread pool. Returns (status code, JSON or None)."""
+    start = time.perf_counter()
+    try:
+        response = http_session.get(url, timeout=API_TIMEOUT)
+    except Exception:
+        metrics.inc("pokeapi_request_errors_total", "error")
+        raise
+    metrics.observe("pokeapi_request_seconds", time.perf_counter() - start, response.status_code)
+    if response.status_code != 200:
+        return response.status_code, None
+    return 200, response.json()
+
+
+async def _fetch_with_retries(url):
+    global api_semaphore
+    if api_semaphore is None:
+        api_semaphore = asyncio.Semaphore(MAX_API_REQUESTS)
+
+    loop = asyncio.get_running_loop()
+    found, data, expires_at = await async_db.run(_load_from_disk, url)
+    if found:
+        cache_stats["disk_hits" if data is not None else "negative_hits"] += 1
+        _remember(url, data, expires_at)
+        return data
+
+    cache_stats["misses"] += 1
+    for attempt in range(API_RETRIES):
+        try:
+            async with api_semaphore:
+                status, data = await loop.run_in_executor(api_executor, _http_get, url)
+            if status in (200, 404):  # A 404 is cached too, retrying won't help
+                expires_at = time.time() + cache_ttl(url, status)
+                _remember(url, data, expires_at)
+                await async_db.run(_store_on_disk, url, status, data, expires_at)
+                return data
+            print(f"⚠️ Attempt {attempt + 1}: {url} returned {status}")
         except requests.exceptions.RequestException as e:
             print(f"⚠️ Attempt {attempt + 1}: API Request Failed - {e}")
-            time.sleep(2)  # Wait before retrying
 
-    print("❌ API request failed after 3 attempts.")
-    return None  # Return None if all retries fail
+        if attempt + 1 < API_RETRIES:
+            await asyncio.sleep(2 ** attempt)  # Back off without blocking other chats
 
+    print(f"❌ API request failed after {API_RETRIES} attempts: {url}")
+    return None
 
-def get_pokemon_stats(pokemon_name):
-    response = requests.get(f"https://pokeapi.co/api/v2/pokemon/{pokemon_name.lower()}")
-    if response.status_code != 200:
+
+async def fetch_json(url):
+    """Fetches a PokeAPI URL without blocking the event loop.
+
+    Returns the decoded JSON, or None if the resource doesn't exist or the API is down.
+    Answers come from the response cache when possible, and identical requests
+    that are already running are awaited instead of repeated.
+    """
+    found, data = _cached_in_memory(url)
+    if found:
+        cache_stats["memory_hits" if data is not None else "negative_hits"] += 1
+        return data
+
+    task = in_flight.get(url)
+    if task is None:
+        task = asyncio.ensure_future(_fetch_with_retries(url))
+        in_flight[url] = task
+        task.add_done_callback(lambda _: in_flight.pop(url, None))
+
+    # Shield so one cancelled handler doesn't cancel the request for everyone else
+    return await asyncio.shield(task)
+
+
+async def prune_response_cache():
+    """Deletes expired api_cache rows at startup and every CACHE_PRUNE_INTERVAL."""
+    while True:
+        removed = await async_db.run(prune_cached_responses)
+        if removed:
+            print(f"🧹 Removed {removed} expired PokeAPI responses from the cache")
+        await asyncio.sleep(CACHE_PRUNE_INTERVAL)
+
+
+def _reset_after_fork():
+    """A forked worker process can't use the parent's threads, loop objects or sockets."""
+    global http_session, api_executor, api_semaphore, spawn_queue
+    http_session = requests.Session()
+    http_session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=MAX_API_REQUESTS))
+    http_session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=MAX_API_REQUESTS))
+    api_executor = ThreadPoolExecutor(max_workers=MAX_API_REQUESTS, thread_name_prefix="pokeapi")
+    api_semaphore = None
+    spawn_queue = None
+    in_flight.clear()
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def close_http_client():
+    """Releases the pooled connections and API worker threads."""
+    api_executor.shutdown(wait=False)
+    http_session.close()
+
+
+def get_random_pokemon():
+    """Picks a random Gen 1 Pokémon from the bundled Pokédex."""
+    entry = pokedex.random_species()
+    return {
+        "name": entry["name"],
+        "image": entry["image"]
+    }
+
+
+async def spawn_producer():
+    """Keeps the spawn queue topped up with ready-to-post Pokémon."""
+    global spawn_queue
+    spawn_queue = asyncio.Queue(maxsize=SPAWN_QUEUE_DEPTH)
+
+    while True:
+        spawn = get_random_pokemon()
+        if spawn is None:
+            await asyncio.sleep(5)  # Try again later
+            continue
+        await spawn_queue.put(spawn)  # Waits here while the queue is full
+
+
+def next_spawn():
+    """Pops a pre-rolled spawn, rolling one on the spot if the queue is empty."""
+    if spawn_queue is not None and not spawn_queue.empty():
+        return spawn_queue.get_nowait()
+    return get_random_pokemon()
+
+
+async def get_pokemon_stats(pokemon_name):
+    entry = pokedex.get_species(pokemon_name)
+    if entry:
+        return pokedex.stats_dict(entry)
+
+    # Not bundled (e.g. added by hand with /add), ask PokeAPI
+    data = await fetch_json(f"{POKEAPI_URL}/pokemon/{pokemon_name.lower()}")
+    if not data:
         return None  # Pokémon not found
 
-    data = response.json()
     stats = {stat["stat"]["name"]: stat["base_stat"] for stat in data["stats"]}
 
     return {
@@ -51,83 +258,154 @@ def get_pokemon_stats(pokemon_name):
         "speed": stats["speed"]
     }
 
-def should_spawn_pokemon(chat_id):
-    """Check if a Pokémon should spawn in this specific chat."""
-    if chat_id not in message_counts:
-        message_counts[chat_id] = 0  # Initialize count for new chat
+async def get_battle_stat(pokemon_name, stat):
+    """Returns one base stat for a battle round, 0 if the Pokémon can't be found."""
+    value = stat_matrix.stat_value(pokemon_name, stat)
+    if value is not None:
+        return value
 
-    if chat_id not in thresholds:
-        thresholds[chat_id] = DEFAULT_THRESHOLD  # Use default threshold
+    stats = await get_pokemon_stats(pokemon_name)  # Not bundled, fall back to PokeAPI
+    return stats.get(stat, 0) if stats else 0
 
-    message_counts[chat_id] += 1
+def load_thresholds():
+    """Loads every group's drop time from the database into memory."""
+    thresholds.clear()
+    thresholds.update(get_drop_times())
 
-    if message_counts[chat_id] >= thresholds[chat_id]:  # Use group-specific threshold
-        message_counts[chat_id] = 0  # Reset counter
-        return True
-    
-    return False
 
-def get_next_evolution(pokemon_name):
-    """Fetches the correct next evolution for a Pokémon from PokeAPI.
-    
-    - If multiple evolutions exist (branch evolution like Eevee), pick randomly.
-    - If a linear evolution (like Pichu → Pikachu → Raichu), return the correct next form.
-    """
-    try:
-        # Fetch species data
-        species_url = f"https://pokeapi.co/api/v2/pokemon-species/{pokemon_name.lower()}/"
-        species_response = requests.get(species_url)
+async def set_threshold(chat_id, threshold):
+    """Saves a group's drop time and updates the in-memory copy (write-through)."""
+    await async_db.set_drop_time(chat_id, threshold)
+    thresholds[chat_id] = threshold
 
-        if species_response.status_code != 200:
-            return None  # Species not found
 
-        species_data = species_response.json()
-        evolution_chain_url = species_data["evolution_chain"]["url"]
+def normalize_name(text):
+    """Reduces a Pokémon name to letters and digits, so "Mr. Mime", "mr-mime" and "mr mime" all match."""
+    return NON_NAME_CHARS.sub("", text.lower().translate(NAME_ALIASES))
 
-        # Fetch evolution chain
-        chain_response = requests.get(evolution_chain_url)
-        if chain_response.status_code != 200:
-            return None  # Evolution chain not found
 
-        evolution_data = chain_response.json()
-        chain = evolution_data["chain"]
+def register_spawn(chat_id, spawn, expires=None):
+    """Makes `spawn` the live Pokémon of a chat and files it for expiry."""
+    expires = time.time() + SPAWN_TTL if expires is None else expires
+    spawn = dict(spawn, key=normalize_name(spawn["name"]), expires=expires)
+    current_pokemon[chat_id] = spawn
+    spawn_wheel.setdefault(int(expires // SPAWN_TICK), set()).add(chat_id)
+    return spawn
 
-        # Traverse the evolution chain
-        while chain:
-            if chain["species"]["name"] == pokemon_name.lower():
-                evolutions = chain["evolves_to"]
 
-                if not evolutions:
-                    return None  # Already at final evolution
+def expire_spawns(now=None):
+    """Drops spawns whose time ran out. Returns how many fled."""
+    now = time.time() if now is None else now
+    fled = 0
+    for tick in [tick for tick in spawn_wheel if tick <= now // SPAWN_TICK]:
+        for chat_id in spawn_wheel.pop(tick):
+            spawn = current_pokemon.get(chat_id)
+            if spawn is not None and spawn["expires"] <= now:
+                del current_pokemon[chat_id]
+                fled += 1
+                metrics.inc("spawns_fled_total")
+            elif spawn is not None and int(spawn["expires"] // SPAWN_TICK) == tick:
+                spawn_wheel.setdefault(tick, set()).add(chat_id)  # Due later within this tick
+    return fled
 
-                if len(evolutions) == 1:
-                    return evolutions[0]["species"]["name"]  # Normal evolution
 
-                # Branch Evolution: Pick a random evolution
-                return random.choice([evo["species"]["name"] for evo in evolutions])
+async def spawn_sweeper():
+    """Expires uncaught spawns every SPAWN_TICK seconds."""
+    while True:
+        await asyncio.sleep(SPAWN_TICK)
+        expire_spawns()
 
-            if not chain["evolves_to"]:
-                return None  # No evolution found
-            chain = chain["evolves_to"][0]
 
-        return None  # No evolution found
+def dump_spawns():
+    return [[chat_id, spawn] for chat_id, spawn in current_pokemon.items()]
 
-    except Exception as e:
-        print(f"Error fetching evolution data: {e}")
-        return None
-    
+
+def load_spawns(pairs):
+    current_pokemon.clear()
+    spawn_wheel.clear()
+    for chat_id, spawn in pairs:
+        if spawn is not None:  # Older snapshots kept caught spawns as None
+            register_spawn(chat_id, spawn, spawn.get("expires"))
 
 
 def should_spawn_pokemon(chat_id):
     """Check if a Pokémon should spawn in this specific chat."""
-    if chat_id not in message_counts:
-        message_counts[chat_id] = 0  # Initialize count for new chat
-
-    drop_time = get_drop_time(chat_id)  # Get threshold from database
-    message_counts[chat_id] += 1
+    count = message_counts.get(chat_id, 0) + 1
 
-    if message_counts[chat_id] >= drop_time:  # Use stored threshold
+    if count >= thresholds.get(chat_id, DEFAULT_THRESHOLD):  # Use group-specific threshold
         message_counts[chat_id] = 0  # Reset counter
         return True
-    
+
+    message_counts[chat_id] = count
     return False
+
+async def handle_group_message(chat_id, user_id, username, text):
+    """Runs the catch and spawn logic for one group message.
+
+    Returns ("caught", pokemon name), ("spawn", spawn) or None; the caller does the sending.
+    """
+    await async_db.add_user(user_id, username)
+
+    # Check the message against the Pokémon waiting in this chat (most chats have none)
+    spawn = current_pokemon.get(chat_id)
+    if spawn is not None and len(text) <= MAX_NAME_LENGTH and normalize_name(text) == spawn["key"]:
+        if spawn["expires"] > time.time():
+            del current_pokemon[chat_id]  # Remove Pokémon from this chat before anyone else can catch it
+            await async_db.add_pokemon(user_id, spawn["name"])
+            metrics.inc("catches_total")
+            return ("caught", spawn["name"])
+
+    # Check if a new Pokémon should spawn in this specific chat
+    if should_spawn_pokemon(chat_id):
+        spawn = register_spawn(chat_id, next_spawn())  # Pre-rolled, no lookup on the hot path
+        metrics.inc("spawns_total")
+        return ("spawn", spawn)
+
+    return None
+
+
+async def load_evolutions(pokemon_name):
+    """Makes sure a Pokémon is in the evolution graph, fetching its chain from PokeAPI if needed."""
+    pokemon_name = pokemon_name.lower()
+    if pokemon_name in pokedex.next_stages:
+        return True
+
+    # Not bundled, fall back to PokeAPI
+    try:
+        species_data = await fetch_json(f"{POKEAPI_URL}/pokemon-species/{pokemon_name}/")
+        if not species_data:
+            return False  # Species not found
+
+        evolution_data = await fetch_json(species_data["evolution_chain"]["url"])
+        if not evolution_data:
+            return False  # Evolution chain not found
+
+        pokedex.add_chain(evolution_data["chain"])
+        return pokemon_name in pokedex.next_stages
+
+    except Exception as e:
+        print(f"Error fetching evolution data: {e}")
+        return False
+
+async def get_next_evolution(pokemon_name):
+    """Returns the next evolution of a Pokémon, or None at its final form.
+
+    On branched chains (like Eevee) one of the branches is picked at random.
+    """
+    await load_evolutions(pokemon_name)
+    evolutions = pokedex.next_stages.get(pokemon_name.lower())
+    if not evolutions:
+        return None
+    return random.choice(evolutions)
+
+async def get_evolution_cost(pokemon_name, evolution=None):
+    """Returns how many copies are needed to evolve a Pokémon (into `evolution`, or its cheapest branch).
+
+    None if it can't evolve.
+    """
+    await load_evolutions(pokemon_name)
+    # The cost depends on whether the target evolves again, which PokeAPI knows for unbundled ones (Porygon2)
+    for target in pokedex.next_stages.get(pokemon_name.lower(), ()):
+        if evolution in (None, target):
+            await load_evolutions(target)
+    return pokedex.evolution_cost(pokemon_name, evolution)
@@ -0,0 +1,158 @@
+"""In-memory leaderboards, kept up to date as the database changes.
+
+database.py reports every change to coins, wins and collections here, and
+rebuild() loads the full state once at startup, so /leaderboard never reads
+SQLite. For each board the best TOP_BUFFER users are kept as a sorted list.
+A user who drops out of that list is only replaced by a full re-rank when
+fewer than the requested number are left.
+
+Owned species are kept as one bitmask per user, which is enough to count
+distinct species without holding anyone's collection in memory.
+"""
+import bisect
+import heapq
+import os
+import threading
+import pokedex
+
+BOARDS = ("pokecoins", "battle_wins", "catches", "species")
+TOP_BUFFER = 50  # Users kept ranked per board, more than any page shows
+
+scores = {board: {} for board in BOARDS}  # Board -> {user_id: score}
+ranked = {board: [] for board in BOARDS}  # Board -> sorted [(-score, user_id)], best first
+owned = {}  # User ID -> bitmask of species with quantity > 0
+usernames = {}  # User ID -> username
+members = {}  # Chat ID -> set of user IDs seen talking in that group
+extra_bits = {}  # Species outside the Pokédex -> bit number
+lock = threading.Lock()
+
+
+def _reset_after_fork():
+    global lock
+    lock = threading.Lock()  # Workers still call add_user() etc. through database.py on their own copy
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _bit(pokemon):
+    entry = pokedex.species_by_name.get(pokemon)
+    if entry:
+        return 1 << entry["id"]
+    if pokemon not in extra_bits:
+        extra_bits[pokemon] = 1024 + len(extra_bits)  # Well above any dex number
+    return 1 << extra_bits[pokemon]
+
+
+def _set(board, user_id, score):
+    """Stores a new score and repositions the user in the ranked buffer."""
+    board_scores = scores[board]
+    top = ranked[board]
+    old = board_scores.get(user_id)
+    board_scores[user_id] = score
+
+    if old is not None:
+        index = bisect.bisect_left(top, (-old, user_id))
+        if index < len(top) and top[index] == (-old, user_id):
+            del top[index]
+
+    # Only re-enter if nobody outside the buffer could rank above this user
+    entry = (-score, user_id)
+    others_outside = len(board_scores) - len(top) - 1
+    if others_outside == 0 or (top and entry < top[-1]):
+        bisect.insort(top, entry)
+        if len(top) > TOP_BUFFER:
+            top.pop()
+
+
+def _add(board, user_id, amount):
+    _set(board, user_id, scores[board].get(user_id, 0) + amount)
+
+
+def _rerank(board):
+    ranked[board] = sorted((-score, user_id) for user_id, score in scores[board].items())[:TOP_BUFFER]
+
+
+def rebuild(users, collection, memberships):
+    """Loads everything from the database.
+
+    `users` are (user_id, username, pokecoins, battle_wins) rows, `collection`
+    (user_id, pokemon, quantity) rows and `memberships` (chat_id, user_id) rows.
+    """
+    with lock:
+        for board in BOARDS:
+            scores[board].clear()
+        owned.clear()
+        usernames.clear()
+        members.clear()
+
+        for user_id, username, pokecoins, battle_wins in users:
+            usernames[user_id] = username
+            scores["pokecoins"][user_id] = pokecoins or 0
+            scores["battle_wins"][user_id] = battle_wins or 0
+        for user_id, pokemon, quantity in collection:
+            scores["catches"][user_id] = scores["catches"].get(user_id, 0) + quantity
+            owned[user_id] = owned.get(user_id, 0) | _bit(pokemon)
+        for user_id, mask in owned.items():
+            scores["species"][user_id] = bin(mask).count("1")
+        for chat_id, user_id in memberships:
+            members.setdefault(chat_id, set()).add(user_id)
+
+        for board in BOARDS:
+            _rerank(board)
+    print(f"🟢 Leaderboards ready for {len(usernames)} users")
+
+
+def add_user(user_id, username):
+    with lock:
+        usernames.setdefault(user_id, username)
+
+
+def add_member(chat_id, user_id):
+    with lock:
+        members.setdefault(chat_id, set()).add(user_id)
+
+
+def add_pokecoins(user_id, amount):
+    with lock:
+        _add("pokecoins", user_id, amount)
+
+
+def add_battle_win(user_id):
+    with lock:
+        _add("battle_wins", user_id, 1)
+
+
+def add_catch(user_id, pokemon, count=1):
+    """Records Pokémon joining a user's collection."""
+    with lock:
+        _add("catches", user_id, count)
+        mask = owned.get(user_id, 0)
+        bit = _bit(pokemon)
+        if not mask & bit:
+            owned[user_id] = mask | bit
+            _add("species", user_id, 1)
+
+
+def remove_pokemon(user_id, pokemon, none_left):
+    """Records one Pokémon leaving a collection; `none_left` if that was the last of its species."""
+    with lock:
+        _add("catches", user_id, -1)
+        bit = _bit(pokemon)
+        if none_left and owned.get(user_id, 0) & bit:
+            owned[user_id] &= ~bit
+            _add("species", user_id, -1)
+
+
+def top(board, count=10, chat_id=None):
+    """Returns [(user_id, username, score)] best first, globally or among one group's members."""
+    with lock:
+        board_scores = scores[board]
+        if chat_id is not None:
+            # Groups are small next to the whole user base, rank their members directly
+            best = heapq.nsmallest(count, ((-board_scores.get(user_id, 0), user_id) for user_id in members.get(chat_id, ())))
+        else:
+            if len(ranked[board]) < min(count, len(board_scores)):
+                _rerank(board)
+            best = ranked[board][:count]
+        return [(user_id, usernames.get(user_id), -score) for score, user_id in best]
@@ -1,29 +1,126 @@
 from telethon import TelegramClient, events,Button 
-from config import API_ID, API_HASH, BOT_TOKEN, BOT_OWNER_ID
-from database import init_db, add_user, add_pokemon, get_collection,distribute_rewards,get_pokecoins,set_drop_time
-from database import setup_shop,add_resource,add_pokemon_to_user,evolve_pokemon,get_db_connection,refresh_shop,buy_pokemon
-from game_logic import get_random_pokemon, should_spawn_pokemon, get_pokemon_stats,get_next_evolution,thresholds
+from telethon import errors, types
+from config import API_ID, API_HASH, BOT_TOKEN, BOT_OWNER_ID, WORKER_PROCESSES
+from database import init_db, close_db, start_write_behind, get_media_refs, load_leaderboards
+from async_db import add_user, add_chat_member, add_pokemon, get_collection,get_collection_page,get_pokemon_count,distribute_rewards,get_pokecoins
+from async_db import add_resource,evolve_pokemon,get_shop_items,stock_shop,prune_shop,buy_pokemon,set_media_ref,delete_media_ref
+import async_db
+import snapshot
+import profiler
+import backup
+import leaderboard
+import database
+import game_logic
+import metrics
+import battles
+import outbox
+from workers import WorkerPool
+from game_logic import message_counts, dump_spawns, load_spawns, spawn_sweeper
+from game_logic import handle_group_message, spawn_producer, get_pokemon_stats,get_battle_stat,get_next_evolution,get_evolution_cost,load_thresholds,set_threshold,close_http_client
 import random
+import sqlite3
 import asyncio
+import io
 import os
-from flask import Flask
+import signal
+import time
+from datetime import datetime, timedelta, timezone
+from flask import Flask, Response
 import threading
 from telethon.tl.functions.users import GetFullUserRequest
 
 bot = TelegramClient("bot_session", API_ID, API_HASH).start(bot_token=BOT_TOKEN)
 
-current_pokemon = None
-
-@bot.on(events.NewMessage(pattern="/start"))
+# Latency histograms for outgoing Telegram requests (event.reply/edit go through these too)
+metrics.describe("telegram_request", "histogram", "Telegram API requests", ["method"])
+for method in ("send_message", "send_file", "edit_message", "get_entity"):
+    setattr(bot, method, metrics.timed("telegram_request", method)(getattr(bot, method)))
+
+metrics.describe("handler", "histogram", "Telegram update handlers", ["handler"])
+
+def post(chat_id, text, **kwargs):
+    """Queues a message through the rate-limited outbox. Await the result only if it's needed."""
+    future = outbox.send(chat_id, bot.send_message, chat_id, text, **kwargs)
+    future.add_done_callback(outbox.log_failure)  # Mostly not awaited
+    return future
+
+def broadcast(messages):
+    """Queues (chat_id, text) pairs at once; recipients are served concurrently, in order per chat."""
+    return asyncio.gather(*(post(chat_id, text) for chat_id, text in messages), return_exceptions=True)
+
+def on(event):
+    """Like bot.on, but records calls, errors and latency per handler."""
+    def decorator(func):
+        bot.add_event_handler(metrics.timed("handler", func.__name__)(func), event)
+        return func
+    return decorator
+
+# Uploaded artwork per Pokémon, so Telegram doesn't refetch the same image every send
+media_refs = {}
+MEDIA_REF_ERRORS = (
+    errors.FileReferenceExpiredError,
+    errors.FileReferenceInvalidError,
+    errors.FileReferenceEmptyError,
+    errors.MediaEmptyError,
+    errors.PhotoInvalidError,
+)
+
+def load_media_refs():
+    """Loads cached artwork uploads from the database."""
+    for pokemon, photo_id, access_hash, file_reference in get_media_refs():
+        media_refs[pokemon] = types.InputPhoto(photo_id, access_hash, file_reference)
+
+async def remember_photo(pokemon_name, message):
+    """Caches the photo Telegram stored for a message we just sent with artwork."""
+    photo = getattr(message, "photo", None)
+    if photo is None:
+        return
+    media_refs[pokemon_name] = types.InputPhoto(photo.id, photo.access_hash, photo.file_reference)
+    await set_media_ref(pokemon_name, photo.id, photo.access_hash, photo.file_reference)
+
+async def forget_photo(pokemon_name):
+    print(f"⚠️ Cached artwork for {pokemon_name} was rejected, uploading it again")
+    media_refs.pop(pokemon_name, None)
+    await delete_media_ref(pokemon_name)
+
+async def send_pokemon_photo(chat_id, pokemon_name, image_url, **kwargs):
+    """Sends a Pokémon's artwork, reusing the cached upload when there is one."""
+    pokemon_name = pokemon_name.lower()
+    photo = media_refs.get(pokemon_name)
+    if photo is not None:
+        try:
+            return await outbox.send(chat_id, bot.send_file, chat_id, photo, **kwargs)
+        except MEDIA_REF_ERRORS:
+            await forget_photo(pokemon_name)
+
+    message = await outbox.send(chat_id, bot.send_file, chat_id, image_url, **kwargs)
+    await remember_photo(pokemon_name, message)
+    return message
+
+async def edit_with_pokemon_photo(event, text, pokemon_name, image_url, **kwargs):
+    """Edits a message to show a Pokémon's artwork, reusing the cached upload when there is one."""
+    pokemon_name = pokemon_name.lower()
+    photo = media_refs.get(pokemon_name)
+    if photo is not None:
+        try:
+            return await event.edit(text, file=photo, **kwargs)
+        except MEDIA_REF_ERRORS:
+            await forget_photo(pokemon_name)
+
+    message = await event.edit(text, file=image_url, **kwargs)
+    await remember_photo(pokemon_name, message)
+    return message
+
+@on(events.NewMessage(pattern="/start"))
 async def start(event):
     user_id = event.sender_id
     username = event.sender.username
 
     # Try to add the user (INSERT OR IGNORE prevents duplicates)
-    add_user(user_id, username)
+    await add_user(user_id, username)
 
     # Check if the user was added (if they already existed, fetch their data)
-    collection = get_collection(user_id)  # Checking if user has Pokémon
+    collection = await get_collection(user_id)  # Checking if user has Pokémon
 
     if collection:  
         await event.reply("✅ You have already started the Pokémon Catcher Game!")
@@ -34,47 +131,56 @@ async def start(event):
 user_pages = {}
 user_messages = {}
 
-@bot.on(events.NewMessage(pattern="/mycollection"))
-async def my_collection(event):
-    user_id = event.sender_id
-    collection = get_collection(user_id)
+PER_PAGE = 10  # Pokémon per collection page
 
-    if not collection:
-        await event.reply("❌ You haven't caught any Pokémon yet!")
-        return
+async def build_collection_page(user_id, page):
+    """Builds the text and navigation buttons for one page of a user's collection.
 
-    # Count duplicate Pokémon
-    poke_count = {poke: collection.count(poke) for poke in set(collection)}
+    Returns (text, buttons, total species); the page is fetched straight from SQLite.
+    """
+    rows, total = await get_collection_page(user_id, page, PER_PAGE)
+    pokemon_list = [f"**{name}** x{count}" if count > 1 else f"**{name}**" for name, count in rows]
+    text = "**📜 Your Pokémon Collection:**\n\n" + "\n".join(pokemon_list)
 
-    # Prepare the Pokémon list with counts and sort alphabetically
-    pokemon_list = sorted([f"**{name}** x{count}" if count > 1 else f"**{name}**" for name, count in poke_count.items()])
+    # Create navigation buttons
+    buttons = []
+    if page > 0:
+        buttons.append(Button.inline("⬅ Previous", data=f"prev_{user_id}"))
+    if (page + 1) * PER_PAGE < total:
+        buttons.append(Button.inline("Next ➡", data=f"next_{user_id}"))
+
+    return text, buttons, total
+
+@on(events.NewMessage(pattern="/mycollection"))
+async def my_collection(event):
+    user_id = event.sender_id
 
     # Initialize user page tracking
     user_pages[user_id] = 0  
 
     # Send the first page of the collection
-    message = await send_collection_page(event, user_id, pokemon_list)
-    user_messages[user_id] = message.id  # Store message ID
+    message = await send_collection_page(event, user_id)
+    if message:
+        user_messages[user_id] = message.id  # Store message ID
 
-async def send_collection_page(event, user_id, pokemon_list):
+async def send_collection_page(event, user_id):
     """Sends a paginated view of the user's Pokémon collection."""
-    page = user_pages.get(user_id, 0)
-    per_page = 10  # Pokémon per page
-    total_pages = (len(pokemon_list) + per_page - 1) // per_page  # Calculate total pages correctly
-
-    start, end = page * per_page, (page + 1) * per_page
-    text = "**📜 Your Pokémon Collection:**\n\n" + "\n".join(pokemon_list[start:end])
+    text, buttons, total = await build_collection_page(user_id, user_pages.get(user_id, 0))
 
-    # Create navigation buttons
-    buttons = []
-    if page > 0:
-        buttons.append(Button.inline("⬅ Previous", data=f"prev_{user_id}"))
-    if page < total_pages - 1:
-        buttons.append(Button.inline("Next ➡", data=f"next_{user_id}"))
+    if not total:
+        await event.reply("❌ You haven't caught any Pokémon yet!")
+        return None
 
     return await event.respond(text, buttons=buttons if buttons else None)
 
-@bot.on(events.CallbackQuery)
+async def edit_page(chat_id, message_id, text, buttons=None):
+    """Edits a collection page; an edit that changes nothing is not an error."""
+    try:
+        return await bot.edit_message(chat_id, message_id, text, buttons=buttons)
+    except errors.MessageNotModifiedError:
+        return None
+
+@on(events.CallbackQuery(pattern=r"(prev|next)_"))
 async def handle_pagination(event):
     """Handles pagination when users click Next/Previous buttons."""
     user_id = event.sender_id
@@ -86,45 +192,33 @@ async def handle_pagination(event):
 
     data = event.data.decode("utf-8")
 
-    # Fetch the original message
-    message = await event.get_message()  # ✅ Fix: Get the message properly
-
     # Update page index
+    page = user_pages.get(user_id, 0)
     if data.startswith("prev_"):
-        user_pages[user_id] = max(0, user_pages[user_id] - 1)
+        page = max(0, page - 1)
     elif data.startswith("next_"):
-        user_pages[user_id] += 1
+        page += 1
 
-    # Fetch and update the collection
-    collection = get_collection(user_id)
-    if not collection:
+    # Fetch just this page of the collection
+    text, buttons, total = await build_collection_page(user_id, page)
+    if not total:
         await event.answer("❌ No Pokémon found!", alert=True)
         return
 
-    poke_count = {poke: collection.count(poke) for poke in set(collection)}
-    pokemon_list = sorted([f"**{name}** x{count}" if count > 1 else f"**{name}**" for name, count in poke_count.items()])
-
-    page = user_pages[user_id]
-    per_page = 10
-    start, end = page * per_page, (page + 1) * per_page
-    text = "**📜 Your Pokémon Collection:**\n\n" + "\n".join(pokemon_list[start:end])
-
-    # Create navigation buttons
-    buttons = []
-    if page > 0:
-        buttons.append(Button.inline("⬅ Previous", data=f"prev_{user_id}"))
-    if end < len(pokemon_list):
-        buttons.append(Button.inline("Next ➡", data=f"next_{user_id}"))
+    if page * PER_PAGE >= total:  # Collection shrank since the last page was sent
+        page = (total - 1) // PER_PAGE
+        text, buttons, total = await build_collection_page(user_id, page)
+    user_pages[user_id] = page
 
-    # 🛠 Fix: Prevent "MessageNotModifiedError"
-    if message.text != text:  # ✅ Now using `message.text` instead of `event.message.text`
-        await bot.edit_message(chat_id, user_messages[user_id], text, buttons=buttons if buttons else None)
+    # Always queue the edit: Telegram's copy may be stale while an earlier edit is still queued.
+    # Rapid Next/Prev clicks collapse into one edit with the latest page.
+    message_id = user_messages[user_id]
+    outbox.edit(chat_id, message_id, edit_page, chat_id, message_id, text, buttons=buttons if buttons else None)
 
     await event.answer()
 
-@bot.on(events.NewMessage)
+@on(events.NewMessage)
 async def message_handler(event):
-    global current_pokemon
     chat_id = event.chat_id
 
     # Ignore PMs (Only track messages in groups)
@@ -133,38 +227,50 @@ async def message_handler(event):
 
     user_id = event.sender_id
     username = event.sender.username
-    text = event.raw_text.lower()
-
-    add_user(user_id, username)
-
-    # Ensure `current_pokemon` is a dictionary
-    if current_pokemon is None:
-        current_pokemon = {}
-
-    # Ensure `chat_id` exists in `current_pokemon` before accessing
-    if chat_id in current_pokemon and current_pokemon[chat_id] is not None:
-        if text == current_pokemon[chat_id]["name"]:
-            add_pokemon(user_id, current_pokemon[chat_id]["name"])
-            await event.reply(f"🎉 {username} caught {current_pokemon[chat_id]['name']}! 🎉")
-            current_pokemon[chat_id] = None  # Remove Pokémon from this chat
-            return  # Exit after catching
-
-    # Check if a new Pokémon should spawn in this specific chat
-    if should_spawn_pokemon(chat_id):
-        current_pokemon[chat_id] = get_random_pokemon()
-        await bot.send_file(
+    text = event.raw_text
+
+    await add_chat_member(chat_id, user_id)
+
+    if worker_pool is not None:
+        leaderboard.add_user(user_id, username)  # The worker stores the user, but the boards live here
+        worker_pool.submit(chat_id, event.id, user_id, username, text)
+        return
+
+    action = await handle_group_message(chat_id, user_id, username, text)
+    if action:
+        await perform_group_action(chat_id, event.id, username, action)
+
+async def perform_group_action(chat_id, message_id, username, action):
+    """Posts the outcome of a group message (a catch or a new spawn)."""
+    kind, payload = action
+    if kind == "caught":
+        post(chat_id, f"🎉 {username} caught {payload}! 🎉", reply_to=message_id)
+    elif kind == "spawn":
+        await send_pokemon_photo(
             chat_id, 
-            current_pokemon[chat_id]["image"], 
+            payload["name"], 
+            payload["image"], 
             caption="🐾 A wild Pokémon appeared! Reply with its name to catch it!"
         )
 
 
 
-# Global battle data storage
-battle_data = {}
+# Pending battle requests (running battles live in battles.sessions)
 battle_timeouts = {}  # To handle battle timeouts
-
-@bot.on(events.NewMessage(pattern="/battle"))
+battle_deadlines = {}  # (challenger, opponent) -> when the pending request times out
+BATTLE_REQUEST_TIMEOUT = 60  # Seconds
+
+# Stat button callback data -> stat key
+STAT_CHOICES = {
+    "hp": "hp",
+    "attack": "attack",
+    "defense": "defense",
+    "sp_attack": "special_attack",
+    "sp_defense": "special_defense",
+    "speed": "speed"
+}
+
+@on(events.NewMessage(pattern="/battle"))
 async def battle(event):
     """Handle the /battle command to initiate a battle."""
     if not event.message.is_reply:
@@ -180,12 +286,12 @@ async def battle(event):
         return
 
     # Check if either player is already in a battle
-    if challenger_id in battle_data or opponent_id in battle_data:
+    if battles.get(challenger_id) or battles.get(opponent_id):
         await event.reply("⚠️ One or both players are already in a battle!")
         return
 
-    challenger_pokemon = get_collection(challenger_id)
-    opponent_pokemon = get_collection(opponent_id)
+    challenger_pokemon = await get_collection(challenger_id)
+    opponent_pokemon = await get_collection(opponent_id)
 
     if not challenger_pokemon or not opponent_pokemon:
         await event.reply("⚠️ Both players need at least **1 Pokémon** to battle!")
@@ -196,24 +302,28 @@ async def battle(event):
         [Button.inline("✅ Accept", f"accept_{challenger_id}_{opponent_id}"),
          Button.inline("❌ Decline", f"decline_{challenger_id}_{opponent_id}")]
     ]
-    await bot.send_message(opponent_id, f"🎮 **You have been challenged to a Pokémon Battle!**\n\n"
-                                        f"**Challenger:** {event.sender.first_name}\n"
-                                        "Do you accept?", buttons=buttons)
+    await post(opponent_id, f"🎮 **You have been challenged to a Pokémon Battle!**\n\n"
+                             f"**Challenger:** {event.sender.first_name}\n"
+                             "Do you accept?", buttons=buttons)
 
     # Set a timeout for the battle request (e.g., 60 seconds)
-    battle_timeouts[(challenger_id, opponent_id)] = asyncio.create_task(
-        battle_timeout(challenger_id, opponent_id)
+    schedule_battle_timeout(challenger_id, opponent_id, BATTLE_REQUEST_TIMEOUT)
+
+def schedule_battle_timeout(challenger_id, opponent_id, delay):
+    battle_deadlines[(challenger_id, opponent_id)] = time.time() + delay
+    battle_timeouts[(challenger_id, opponent_id)] = bot.loop.create_task(
+        battle_timeout(challenger_id, opponent_id, delay)
     )
 
-async def battle_timeout(challenger_id, opponent_id):
+async def battle_timeout(challenger_id, opponent_id, delay):
     """Handle battle request timeouts."""
-    await asyncio.sleep(60)  # 60 seconds timeout
+    await asyncio.sleep(delay)
     if (challenger_id, opponent_id) in battle_timeouts:
-        await bot.send_message(challenger_id, "⚠️ Battle request timed out!")
-        await bot.send_message(opponent_id, "⚠️ Battle request timed out!")
+        broadcast([(challenger_id, "⚠️ Battle request timed out!"), (opponent_id, "⚠️ Battle request timed out!")])
         del battle_timeouts[(challenger_id, opponent_id)]
+        battle_deadlines.pop((challenger_id, opponent_id), None)
 
-@bot.on(events.CallbackQuery(pattern=r"accept_(\d+)_(\d+)"))
+@on(events.CallbackQuery(pattern=r"accept_(\d+)_(\d+)"))
 async def accept_battle(event):
     """Handle battle acceptance."""
     challenger_id, opponent_id = map(int, event.data.decode().split("_")[1:])
@@ -222,108 +332,100 @@ async def accept_battle(event):
     if (challenger_id, opponent_id) in battle_timeouts:
         battle_timeouts[(challenger_id, opponent_id)].cancel()
         del battle_timeouts[(challenger_id, opponent_id)]
+        battle_deadlines.pop((challenger_id, opponent_id), None)
 
-    challenger_pokemon = get_collection(challenger_id)
-    opponent_pokemon = get_collection(opponent_id)
+    challenger_pokemon = await get_collection(challenger_id)
+    opponent_pokemon = await get_collection(opponent_id)
 
     if not challenger_pokemon or not opponent_pokemon:
-        await bot.send_message(challenger_id, "⚠️ Battle canceled! One or both players have no Pokémon.")
-        await bot.send_message(opponent_id, "⚠️ Battle canceled! One or both players have no Pokémon.")
+        canceled = "⚠️ Battle canceled! One or both players have no Pokémon."
+        broadcast([(challenger_id, canceled), (opponent_id, canceled)])
         return
 
-    # Pick random Pokémon for each player (max 5)
-    challenger_pokemon = random.sample(challenger_pokemon, min(5, len(challenger_pokemon)))
-    opponent_pokemon = random.sample(opponent_pokemon, min(5, len(opponent_pokemon)))
+    # Pick random Pokémon for each player (max 5), weighted by how many of each they own
+    challenger_pokemon = random.sample(list(challenger_pokemon), min(5, sum(challenger_pokemon.values())),
+                                       counts=list(challenger_pokemon.values()))
+    opponent_pokemon = random.sample(list(opponent_pokemon), min(5, sum(opponent_pokemon.values())),
+                                     counts=list(opponent_pokemon.values()))
 
     turn = random.choice([challenger_id, opponent_id])
 
-    # Initialize battle data
-    battle_data[challenger_id] = {"opponent": opponent_id, "pokemon": challenger_pokemon, "score": 0}
-    battle_data[opponent_id] = {"opponent": challenger_id, "pokemon": opponent_pokemon, "score": 0}
+    if battles.get(challenger_id) or battles.get(opponent_id):
+        await event.answer("⚠️ One or both players are already in a battle!", alert=True)
+        return
 
-    challenger_entity = await bot.get_entity(challenger_id)
-    opponent_entity = await bot.get_entity(opponent_id)
+    battles.start(challenger_id, opponent_id, challenger_pokemon, opponent_pokemon)
 
-    await bot.send_message(challenger_id, f"✅ Battle Accepted! You will face {opponent_entity.first_name}")
-    await bot.send_message(opponent_id, f"✅ Battle Accepted! You will face {challenger_entity.first_name}")
+    challenger_entity, opponent_entity = await asyncio.gather(bot.get_entity(challenger_id), bot.get_entity(opponent_id))
+
+    broadcast([(challenger_id, f"✅ Battle Accepted! You will face {opponent_entity.first_name}"),
+               (opponent_id, f"✅ Battle Accepted! You will face {challenger_entity.first_name}")])
 
     await start_round(turn)
 
-@bot.on(events.CallbackQuery(pattern=r"decline_(\d+)_(\d+)"))
+@on(events.CallbackQuery(pattern=r"decline_(\d+)_(\d+)"))
 async def decline_battle(event):
     """Handle battle decline."""
     challenger_id, _ = map(int, event.data.decode().split("_")[1:])
     await event.answer("❌ Battle Declined", alert=True)
-    await bot.send_message(challenger_id, "⚠️ Your opponent declined the battle!")
+    post(challenger_id, "⚠️ Your opponent declined the battle!")
 
 async def start_round(player_id):
     """Start a new round of the battle."""
     buttons = get_stat_buttons()
-    await bot.send_message(player_id, "🎮 **Choose a stat for this round!**", buttons=buttons)
+    post(player_id, "🎮 **Choose a stat for this round!**", buttons=buttons)
 
-@bot.on(events.CallbackQuery(pattern=r"pick_(.+)"))
+@on(events.CallbackQuery(pattern=r"pick_(.+)"))
 async def handle_pick_stat(event):
     """Handle stat selection for the battle round."""
     user_id = event.sender_id
     stat_choice = event.data.decode().split("_", 1)[1]  # Extract the chosen stat
 
-    if user_id not in battle_data:
+    battle = battles.get(user_id)
+    if battle is None:
         await event.answer("⚠️ You're not in an active battle!", alert=True)
         return
 
-    # Map button callback data to stat keys
-    stat_map = {
-        "hp": "hp",
-        "attack": "attack",
-        "defense": "defense",
-        "sp_attack": "special_attack",
-        "sp_defense": "special_defense",
-        "speed": "speed"
-    }
-
-    if stat_choice not in stat_map:
+    if stat_choice not in STAT_CHOICES:
         await event.answer("⚠️ Invalid choice!", alert=True)
         return
 
-    chosen_stat = stat_map[stat_choice]
-    battle = battle_data[user_id]
-    opponent_id = battle["opponent"]
+    chosen_stat = STAT_CHOICES[stat_choice]
+    opponent_id = battle.opponent(user_id)
 
     # Store the chosen stat
-    battle_data[user_id]["chosen_stat"] = chosen_stat
+    both_chosen = battle.choose(user_id, chosen_stat)
     print(f"Player {user_id} chose stat: {chosen_stat}")
 
     await event.edit(f"✅ You have chosen **{chosen_stat.upper()}**!,Wait for your turn")
 
     # Check if opponent has chosen a stat
-    if "chosen_stat" in battle_data[opponent_id]:
-        await compare_stats(user_id, opponent_id)
+    if both_chosen:
+        await compare_stats(battle)
     else:
-        await bot.send_message(opponent_id, "🔹 Your opponent has chosen a stat! Choose yours now.", buttons=get_stat_buttons())
+        post(opponent_id, "🔹 Your opponent has chosen a stat! Choose yours now.", buttons=get_stat_buttons())
 
-async def compare_stats(player1, player2):
+async def compare_stats(battle):
     """Compare stats and determine the round winner."""
-    if not battle_data.get(player1) or not battle_data.get(player2):
-        return
+    if battles.get(battle.players[0]) is not battle or None in battle.chosen:
+        return  # Already finished, expired, or this round was already compared
 
-    if not battle_data[player1]["pokemon"] or not battle_data[player2]["pokemon"]:
-        await declare_winner(player1, player2)
+    player1, player2 = battle.players
+    if not battle.pokemon[0] or not battle.pokemon[1]:
+        await declare_winner(battle)
         return
 
-    p1_pokemon = battle_data[player1]["pokemon"].pop(0)
-    p2_pokemon = battle_data[player2]["pokemon"].pop(0)
-
-    p1_stats = get_pokemon_stats(p1_pokemon) or {}
-    p2_stats = get_pokemon_stats(p2_pokemon) or {}
+    p1_pokemon = battle.pokemon[0].pop(0)
+    p2_pokemon = battle.pokemon[1].pop(0)
 
     # Get each player's chosen stat
-    stat1 = battle_data[player1].pop("chosen_stat")
-    stat2 = battle_data[player2].pop("chosen_stat")
+    stat1, stat2 = battle.chosen
+    battle.chosen = [None, None]
 
     print(f"Comparing stats for {p1_pokemon} ({stat1}) vs {p2_pokemon} ({stat2})")
 
-    stat_value_1 = p1_stats.get(stat1, 0)
-    stat_value_2 = p2_stats.get(stat2, 0)
+    stat_value_1 = await get_battle_stat(p1_pokemon, stat1)
+    stat_value_2 = await get_battle_stat(p2_pokemon, stat2)
 
     print(f"{p1_pokemon} {stat1}: {stat_value_1}")
     print(f"{p2_pokemon} {stat2}: {stat_value_2}")
@@ -337,35 +439,33 @@ async def compare_stats(player1, player2):
     result_message = f"⚔️ **{p1_pokemon}** ({stat1.upper()}: {stat_value_1}) vs **{p2_pokemon}** ({stat2.upper()}: {stat_value_2})\n"
 
     if winner:
-        battle_data[winner]["score"] += 1
+        battle.scores[battle.side(winner)] += 1
         winner_entity = await bot.get_entity(winner)
         result_message += f"🏆 **{winner_entity.first_name} wins this round!**"
     else:
         result_message += "⚖️ **It's a tie!**"
 
-    await bot.send_message(player1, result_message)
-    await bot.send_message(player2, result_message)
+    broadcast([(player1, result_message), (player2, result_message)])
 
     # Track round history
-    battle_data[player1].setdefault("round_history", []).append(result_message)
-    battle_data[player2].setdefault("round_history", []).append(result_message)
+    battle.history.append(result_message)
 
     # If both players have Pokémon left, start the next round
-    if battle_data[player1]["pokemon"]:
+    if battle.pokemon[0] and battle.pokemon[1]:
         await start_round(player2 if winner == player1 else player1)
     else:
-        await declare_winner(player1, player2)
+        await declare_winner(battle)
 
 
-async def declare_winner(player1, player2):
-    if player1 not in battle_data or player2 not in battle_data:
+async def declare_winner(battle):
+    if battles.get(battle.players[0]) is not battle:
         return
+    battles.end(battle)  # Before any await, so the result is only paid out once
 
-    score1 = battle_data[player1].get("score", 0)
-    score2 = battle_data[player2].get("score", 0)
+    player1, player2 = battle.players
+    score1, score2 = battle.scores
 
-    player1_entity = await bot.get_entity(player1)
-    player2_entity = await bot.get_entity(player2)
+    player1_entity, player2_entity = await asyncio.gather(bot.get_entity(player1), bot.get_entity(player2))
 
     # Build the final battle summary
     summary = "\U0001F3C6 **Battle Over! Final Scores:**\n"
@@ -373,7 +473,7 @@ async def declare_winner(player1, player2):
     summary += f"\U0001F539 {player2_entity.first_name}: {score2} Wins\n\n"
     summary += "**Round History:**\n"
 
-    for i, result in enumerate(battle_data[player1].get("round_history", []), start=1):
+    for i, result in enumerate(battle.history, start=1):
         summary += f"**Round {i}**\n{result}\n"
 
     # Determine the winner and loser
@@ -388,19 +488,23 @@ async def declare_winner(player1, player2):
         summary += "\n⚖️ **It's a tie!**"
 
     # Distribute rewards
-    winner_reward, loser_reward = distribute_rewards(winner_id, loser_id, score1, score2)
-
-    # Notify players of their rewards
-    await bot.send_message(winner_id, f"\U0001F3C6 You won the battle and earned {winner_reward} PokéCoins!")
-    await bot.send_message(loser_id, f"\U0001F494 You lost the battle but earned {loser_reward} PokéCoins!")
-
-    # Send the summary to both players
-    await bot.send_message(player1, summary)
-    await bot.send_message(player2, summary)
-
-    # Clean up battle data
-    del battle_data[player1]
-    del battle_data[player2]
+    winner_reward, loser_reward = await distribute_rewards(winner_id, loser_id, score1, score2)
+
+    # Notify players of their rewards, then send both the summary
+    broadcast([
+        (winner_id, f"\U0001F3C6 You won the battle and earned {winner_reward} PokéCoins!"),
+        (loser_id, f"\U0001F494 You lost the battle but earned {loser_reward} PokéCoins!"),
+        (player1, summary),
+        (player2, summary),
+    ])
+
+async def sweep_battles():
+    """Closes battles where nobody picked a stat before the turn deadline."""
+    while True:
+        await asyncio.sleep(battles.SWEEP_INTERVAL)
+        for battle in battles.expired():
+            battles.end(battle)
+            broadcast([(player, "⌛ Battle expired because nobody picked a stat in time.") for player in battle.players])
 
 def get_stat_buttons():
     return [
@@ -411,45 +515,39 @@ def get_stat_buttons():
 
 
 
-@bot.on(events.NewMessage(pattern="/myinventory"))
+@on(events.NewMessage(pattern="/myinventory"))
 async def my_inventory(event):
     user_id = event.sender_id
-    pokecoins = get_pokecoins(user_id)
+    pokecoins = await get_pokecoins(user_id)
 
     await event.reply(f"💰 **Your PokéCoins:** {pokecoins}")
 
 
 
-@bot.on(events.NewMessage(pattern="/stats (.+)"))
+@on(events.NewMessage(pattern="/stats (.+)"))
 async def pokemon_stats(event):
     user_id = event.sender_id
     pokemon_name = event.pattern_match.group(1).strip().lower()
 
     # Check if the Pokémon is in the user's collection
-    collection = get_collection(user_id)
+    pokemon_count = await get_pokemon_count(user_id, pokemon_name)
 
-    if not collection or pokemon_name not in [poke.lower() for poke in collection]:
+    if not pokemon_count:
         await event.reply(f"❌ You don’t own {pokemon_name.capitalize()}!")
         return
 
     # Get Pokémon stats
-    stats = get_pokemon_stats(pokemon_name)
+    stats = await get_pokemon_stats(pokemon_name)
     
     if not stats:
         await event.reply("❌ Pokémon not found! Make sure you entered the correct name.")
         return
 
-    # Count how many of this Pokémon the user owns
-    pokemon_count = sum(1 for poke in collection if poke.lower() == pokemon_name)
-
     # Get evolution details
-    evolved_pokemon = get_next_evolution(pokemon_name)
+    required_count = await get_evolution_cost(pokemon_name)
     evolve_button = None  # Default: No button
 
-    if evolved_pokemon:
-        next_evolution = get_next_evolution(evolved_pokemon)  # Check if it's final form
-        required_count = 10 if next_evolution else 20  # 1 for second form, 2 for final form
-
+    if required_count:
         # Button text logic
         if pokemon_count >= required_count:
             button_text = f"✅ Ready to Evolve! ({pokemon_count}/{required_count})"
@@ -470,40 +568,38 @@ async def pokemon_stats(event):
         f"⚡ Speed: {stats['speed']}"
     )
 
-    await bot.send_file(event.chat_id, stats["image"], caption=message, buttons=evolve_button)
+    await send_pokemon_photo(event.chat_id, stats["name"], stats["image"], caption=message, buttons=evolve_button)
 
 
-@bot.on(events.CallbackQuery(pattern=r"evolve_(.+)"))
+@on(events.CallbackQuery(pattern=r"evolve_(.+)"))
 async def evolve_button(event):
     user_id = event.sender_id
     pokemon_name = event.data.decode().split("_", 1)[1]  # Get the Pokémon name
 
-    collection = get_collection(user_id)
+    # Count how many of this Pokémon the user has
+    pokemon_count = await get_pokemon_count(user_id, pokemon_name)
 
-    if pokemon_name not in [poke.lower() for poke in collection]:
+    if not pokemon_count:
         await event.answer(f"❌ You no longer have {pokemon_name.capitalize()}!", alert=True)
         return
 
-    evolved_pokemon = get_next_evolution(pokemon_name)
+    # Pick the branch once, so the cost checked is the cost of the evolution performed
+    evolved_pokemon = await get_next_evolution(pokemon_name)
+    required_count = await get_evolution_cost(pokemon_name, evolved_pokemon) if evolved_pokemon else None
 
-    if not evolved_pokemon:
+    if not required_count:
         await event.answer(f"❌ {pokemon_name.capitalize()} cannot evolve further!", alert=True)
         return
 
-    # Count how many of this Pokémon the user has
-    pokemon_count = sum(1 for poke in collection if poke.lower() == pokemon_name)
-    next_evolution = get_next_evolution(evolved_pokemon)  # Check if it's the final form
-    required_count = 10 if next_evolution else 20  # 1 Pokémon for 2nd form, 2 for final form
-
     if pokemon_count < required_count:
         await event.answer(f"❌ You need at least {required_count} copies of {pokemon_name.capitalize()} to evolve!", alert=True)
         return
 
     # Perform Evolution: Remove base form & add evolved form
-    evolve_pokemon(user_id, pokemon_name, evolved_pokemon)  # Database update
+    await evolve_pokemon(user_id, pokemon_name, evolved_pokemon)  # Database update
 
     # Fetch new stats and image
-    evolved_stats = get_pokemon_stats(evolved_pokemon)
+    evolved_stats = await get_pokemon_stats(evolved_pokemon)
     
     if evolved_stats:
         # Build new stats message
@@ -519,22 +615,17 @@ async def evolve_button(event):
         )
 
         # Send updated message with the evolved Pokémon's image
-        await event.edit(new_message, file=evolved_stats["image"], buttons=None)
+        await edit_with_pokemon_photo(event, new_message, evolved_pokemon, evolved_stats["image"], buttons=None)
     else:
         await event.edit(f"🎉 **{pokemon_name.capitalize()} evolved into {evolved_pokemon.capitalize()}!** ✨")
 
 
-@bot.on(events.NewMessage(pattern="/shop"))
+@on(events.NewMessage(pattern="/shop"))
 async def shop(event):
     user_id = event.sender_id
 
-    refresh_shop()  # Ensure shop is set for today
-
-    # Get today's Pokémon shop list
-    conn, cursor = get_db_connection()
-    cursor.execute("SELECT pokemon, price FROM shop WHERE date = DATE('now')")
-    shop_items = cursor.fetchall()
-    conn.close()
+    # Get today's Pokémon shop list (stocked ahead of time by schedule_shop)
+    shop_items = await get_shop_items()
 
     if not shop_items:
         await event.reply("❌ No Pokémon available in the shop today. Try again tomorrow!")
@@ -550,16 +641,36 @@ async def shop(event):
     await event.reply(message, buttons=buttons)
 
 
-@bot.on(events.CallbackQuery(pattern=r"buy_(.+)"))
+SHOP_ROLLOVER_DELAY = 5  # Seconds past UTC midnight before pruning yesterday's shop
+SHOP_RETRY_INTERVAL = 60  # Seconds before retrying after an error
+
+async def schedule_shop():
+    """Keeps today's and tomorrow's shops stocked, so midnight needs no work on the /shop path."""
+    while True:
+        try:
+            await stock_shop(database.shop_date())
+            await stock_shop(database.shop_date(1))
+            await prune_shop()
+        except Exception as e:  # Anything uncaught would end the task and the shop would never restock
+            print(f"🔴 Couldn't stock the shop: {e!r}")
+            await asyncio.sleep(SHOP_RETRY_INTERVAL)
+            continue
+
+        now = datetime.now(timezone.utc)
+        midnight = datetime(now.year, now.month, now.day, tzinfo=timezone.utc) + timedelta(days=1)
+        await asyncio.sleep((midnight - now).total_seconds() + SHOP_ROLLOVER_DELAY)
+
+
+@on(events.CallbackQuery(pattern=r"buy_(.+)"))
 async def buy_button(event):
     user_id = event.sender_id
     pokemon_name = event.data.decode().split("_", 1)[1]  # Extract Pokémon name
 
-    result = buy_pokemon(user_id, pokemon_name)
+    result = await buy_pokemon(user_id, pokemon_name)
     await event.answer(result, alert=True)
 
 
-@bot.on(events.NewMessage(pattern=r"/add (\w+) (\S+) (\d+)"))
+@on(events.NewMessage(pattern=r"/add (\w+) (\S+) (\d+)"))
 async def add_resource_command(event):
     sender_id = event.sender_id
     if sender_id != BOT_OWNER_ID:
@@ -577,11 +688,11 @@ async def add_resource_command(event):
         if amount <= 0:
             await event.reply("❌ Amount must be greater than zero!")
             return
-        result = add_resource(target_user_id, "pokecoins", amount)
+        result = await add_resource(target_user_id, "pokecoins", amount)
 
     elif resource == "pokemon":
         pokemon_name = amount_or_pokemon.lower()
-        add_pokemon(target_user_id, pokemon_name)  # Use your existing function
+        await add_pokemon(target_user_id, pokemon_name)  # Use your existing function
         result = f"✅ Successfully added {pokemon_name.capitalize()} to user {target_user_id}!"
 
     else:
@@ -600,26 +711,55 @@ app = Flask(__name__)
 def home():
     return "Bot is running"
 
+@app.route('/metrics')
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
 def run_server():
     app.run(host="0.0.0.0", port=8000)
 
-threading.Thread(target=run_server, daemon=True).start()
 
+@on(events.NewMessage(pattern="/backup"))
+async def send_backup(event):
+    if event.sender_id != BOT_OWNER_ID:
+        await event.reply("You are not authorized to use this command.")
+        return
 
-@bot.on(events.NewMessage(pattern="/backup"))
-async def backup(event):
+    # Hand over the newest finished backup; only take one now if there is none yet
+    path = backup.latest_backup()
+    if path is None:
+        try:
+            path = await backup.run_backup()
+        except (OSError, sqlite3.Error) as e:
+            await event.reply(f"❌ Backup failed: {e}")
+            return
+
+    taken = time.strftime("%Y-%m-%d %H:%M", time.localtime(os.path.getmtime(path)))
+    await bot.send_file(event.chat_id, path, caption=f"Here is the latest database backup (taken {taken}, gzip).")
+
+@on(events.NewMessage(pattern=r"/profile(?:\s+(\d+))?\s*$"))
+async def profile_command(event):
     if event.sender_id != BOT_OWNER_ID:
         await event.reply("You are not authorized to use this command.")
         return
 
-    db_path = "pokemon_game.db"
+    seconds = min(int(event.pattern_match.group(1) or profiler.DEFAULT_SECONDS), profiler.MAX_SECONDS)
+    if profiler.running:
+        await event.reply("⚠️ A profile is already running.")
+        return
+
+    await event.reply(f"🔬 Profiling for {seconds}s, the report will follow.")
+    try:
+        report = await profiler.profile(seconds)
+    except RuntimeError:  # Another /profile started while the reply above was being sent
+        await event.reply("⚠️ A profile is already running.")
+        return
 
-    if os.path.exists(db_path):
-        await bot.send_file(event.chat_id, db_path, caption="Here is the latest database backup.")
-    else:
-        await event.reply("Database file not found.")
+    report_file = io.BytesIO(report.encode())
+    report_file.name = f"profile-{time.strftime('%Y%m%d-%H%M%S')}.txt"
+    await bot.send_file(event.chat_id, report_file, caption=f"🔬 Profile report ({seconds}s)")
 
-@bot.on(events.NewMessage(pattern=r"/drop_time (\d+)"))
+@on(events.NewMessage(pattern=r"/drop_time (\d+)"))
 async def change_threshold(event):
     sender_id = event.sender_id
     chat_id = event.chat_id  # Get the group ID
@@ -634,12 +774,128 @@ async def change_threshold(event):
         await event.reply("❌ Threshold must be at least 1!")
         return
 
-    # Update the threshold for this specific group in the database
-    set_drop_time(chat_id, new_threshold)
+    # Update the threshold for this specific group (database and memory)
+    await set_threshold(chat_id, new_threshold)
+    if worker_pool is not None:
+        worker_pool.set_threshold(chat_id, new_threshold)
 
     await event.reply(f"✅ Pokémon spawn threshold updated to **{new_threshold} messages** for this group!")
 
-setup_shop()
+# /leaderboard [pokecoins|wins|catches|species] [global], served from memory
+LEADERBOARD_NAMES = {
+    "pokecoins": "pokecoins", "coins": "pokecoins",
+    "battle_wins": "battle_wins", "wins": "battle_wins",
+    "catches": "catches",
+    "species": "species", "dex": "species",
+}
+LEADERBOARD_TITLES = {
+    "pokecoins": "💰 PokéCoins",
+    "battle_wins": "⚔️ Battle Wins",
+    "catches": "🎯 Pokémon Caught",
+    "species": "📘 Species Collected",
+}
+LEADERBOARD_SIZE = 10
+
+@on(events.NewMessage(pattern=r"/leaderboard(?:@\w+)?(?:\s+(\w+))?(?:\s+(global))?\s*$"))
+async def show_leaderboard(event):
+    board = LEADERBOARD_NAMES.get((event.pattern_match.group(1) or "pokecoins").lower())
+    if board is None:
+        await event.reply("❌ Pick one of: pokecoins, wins, catches, species")
+        return
+
+    # In a group show that group's members, unless `global` was asked for
+    chat_id = None if event.is_private or event.pattern_match.group(2) else event.chat_id
+    rows = leaderboard.top(board, LEADERBOARD_SIZE, chat_id=chat_id)
+    scope = "this group" if chat_id is not None else "everyone"
+
+    if not rows:
+        await event.reply(f"📭 No one is on the {LEADERBOARD_TITLES[board]} leaderboard for {scope} yet!")
+        return
+
+    medals = ["🥇", "🥈", "🥉"]
+    lines = [f"🏆 **{LEADERBOARD_TITLES[board]} — {scope}**\n"]
+    for rank, (user_id, username, score) in enumerate(rows, start=1):
+        badge = medals[rank - 1] if rank <= len(medals) else f"{rank}."
+        name = f"@{username}" if username else f"User {user_id}"
+        lines.append(f"{badge} {name}: **{score}**")
+    await event.reply("\n".join(lines))
+
+# Warm-restart snapshot of the in-memory game state
+def dump_pairs(mapping):
+    return [[key, value] for key, value in mapping.items()]
+
+def load_pairs(mapping):
+    def load(pairs):
+        mapping.clear()
+        mapping.update((key, value) for key, value in pairs)
+    return load
+
+def dump_battle_requests():
+    return [[challenger_id, opponent_id, deadline] for (challenger_id, opponent_id), deadline in battle_deadlines.items()]
+
+def load_battle_requests(requests):
+    # Pending requests keep whatever time they had left (at least a few seconds)
+    for challenger_id, opponent_id, deadline in requests:
+        schedule_battle_timeout(challenger_id, opponent_id, max(5, deadline - time.time()))
+
+if not WORKER_PROCESSES:  # Otherwise each worker snapshots its own chats
+    snapshot.register("message_counts", lambda: dump_pairs(message_counts), load_pairs(message_counts))
+    snapshot.register("current_pokemon", dump_spawns, load_spawns)
+snapshot.register("battles", battles.dump, battles.load)
+snapshot.register("battle_requests", dump_battle_requests, load_battle_requests)
+snapshot.register("user_pages", lambda: dump_pairs(user_pages), load_pairs(user_pages))
+snapshot.register("user_messages", lambda: dump_pairs(user_messages), load_pairs(user_messages))
+
+# Gauges, read only when /metrics is scraped
+# In worker mode the spawns live in the workers, which report their counts to the pool
+metrics.register_callback("active_spawns", "gauge", "Chats with a wild Pokémon waiting",
+                          lambda: sum(worker_pool.active_spawns) if worker_pool else len(game_logic.current_pokemon))
+metrics.register_callback("active_battles", "gauge", "Battles in progress", lambda: len({id(b) for b in list(battles.sessions.values())}))
+metrics.register_callback("pending_battle_requests", "gauge", "Battle requests waiting for an answer", lambda: len(battle_timeouts))
+metrics.register_callback("spawn_queue_depth", "gauge", "Pre-rolled spawns ready to post",
+                          lambda: sum(worker_pool.queued_spawns) if worker_pool
+                          else game_logic.spawn_queue.qsize() if game_logic.spawn_queue else 0)
+metrics.register_callback("cache_entries", "gauge", "Entries held in memory per cache", lambda: {
+    "pokeapi": len(game_logic.response_cache),
+    "media_refs": len(media_refs),
+    "known_users": len(database.known_users),
+}, label="cache")
+metrics.register_callback("pending_writes", "gauge", "Rows waiting in the write-behind queue", lambda: {
+    "users": len(database.pending_users),
+    "catches": len(database.pending_catches),
+}, label="table")
+metrics.register_callback("pokeapi_cache_lookups_total", "counter", "PokeAPI cache lookups by result",
+                          lambda: dict(game_logic.cache_stats), label="result")
+
 init_db()
+worker_pool = None
+if WORKER_PROCESSES:
+    close_db()  # Workers are forked and must not inherit open connections
+    worker_pool = WorkerPool(WORKER_PROCESSES)
+    bot.loop.create_task(worker_pool.pump_replies(perform_group_action))
+threading.Thread(target=run_server, daemon=True).start()  # After the fork, workers must not inherit threads
+start_write_behind()
+load_leaderboards()
+load_thresholds()
+load_media_refs()
+snapshot.restore()
+if worker_pool is None:
+    bot.loop.create_task(spawn_producer())
+    bot.loop.create_task(spawn_sweeper())
+bot.loop.create_task(snapshot.autosave())
+bot.loop.create_task(sweep_battles())
+bot.loop.create_task(backup.schedule_backups())
+bot.loop.create_task(schedule_shop())
+bot.loop.create_task(game_logic.prune_response_cache())
+# docker stop sends SIGTERM; disconnecting lets the shutdown below flush and save everything
+bot.loop.add_signal_handler(signal.SIGTERM, lambda: bot.loop.create_task(bot.disconnect()))
 print("Bot is running...")
-bot.run_until_disconnected()
+try:
+    bot.run_until_disconnected()
+finally:  # Also after Ctrl+C or a crash in the loop, so the last state is saved
+    snapshot.save(force=True)
+    if worker_pool is not None:
+        worker_pool.stop()
+    close_http_client()
+    async_db.shutdown()
+    close_db()
@@ -0,0 +1,151 @@
+"""In-process metrics, rendered in the Prometheus text format for /metrics.
+
+Counters and histograms are plain dicts keyed by (name, label values) and
+guarded by one lock, since database and HTTP calls finish on worker threads.
+Gauges are callbacks that are only evaluated when /metrics is scraped.
+"""
+import bisect
+import os
+import threading
+import time
+from functools import wraps
+
+# Upper bounds in seconds; one extra bucket catches everything slower (+Inf)
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+descriptions = {}  # Metric name -> (type, help text, label names)
+counters = {}  # (name, label values) -> value
+histograms = {}  # (name, label values) -> [bucket counts, sum, count]
+callbacks = {}  # Metric name -> function returning a number or {label value: number}
+lock = threading.Lock()
+
+
+def _reset_after_fork():
+    global lock
+    lock = threading.Lock()  # A DB or HTTP thread could be mid-observe() when a worker is forked
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def describe(name, kind, help_text, labels=()):
+    """Declares a metric. `kind` is "counter", "gauge" or "histogram"."""
+    descriptions[name] = (kind, help_text, tuple(labels))
+
+
+def inc(name, *label_values, amount=1):
+    key = (name, label_values)
+    with lock:
+        counters[key] = counters.get(key, 0) + amount
+
+
+def observe(name, seconds, *label_values):
+    key = (name, label_values)
+    index = bisect.bisect_left(LATENCY_BUCKETS, seconds)
+    with lock:
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = [[0] * (len(LATENCY_BUCKETS) + 1), 0.0, 0]
+        histogram[0][index] += 1
+        histogram[1] += seconds
+        histogram[2] += 1
+
+
+def register_callback(name, kind, help_text, func, label=None):
+    """Adds a gauge (or a counter kept elsewhere) read from `func()` at scrape time.
+
+    `func` runs on the HTTP server's thread while the event loop keeps changing
+    the game state, so it must copy a dict (list(d.values())) before iterating it.
+    """
+    describe(name, kind, help_text, (label,) if label else ())
+    callbacks[name] = func
+
+
+def timed(name, *label_values):
+    """Decorates a coroutine function with a latency histogram and an error counter."""
+    def decorator(func):
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            except Exception:
+                inc(f"{name}_errors_total", *label_values)
+                raise
+            finally:
+                observe(f"{name}_seconds", time.perf_counter() - start, *label_values)
+        return wrapper
+    return decorator
+
+
+def _labels(names, values, extra=""):
+    pairs = [f'{label}="{_escape(value)}"' for label, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _family(name):
+    for suffix in ("_seconds", "_errors_total"):
+        if name.endswith(suffix) and name[:-len(suffix)] in descriptions:
+            return name[:-len(suffix)], suffix
+    return name, ""
+
+
+def render():
+    """Returns every metric in the Prometheus text exposition format."""
+    with lock:
+        counter_items = sorted(counters.items())
+        histogram_items = sorted((key, [list(h[0]), h[1], h[2]]) for key, h in histograms.items())
+
+    lines = []
+    headed = set()
+
+    def head(name, kind, help_text):
+        if name not in headed:
+            headed.add(name)
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+
+    def label_names(name):
+        family, _ = _family(name)
+        return descriptions.get(name, descriptions.get(family, ("", "", ())))[2]
+
+    for (name, values), value in counter_items:
+        family, suffix = _family(name)
+        help_text = descriptions.get(name, descriptions.get(family, ("", name, ())))[1]
+        head(name, "counter", help_text + (" (failed calls)" if suffix else ""))
+        lines.append(f"{name}{_labels(label_names(name), values)} {value}")
+
+    for (name, values), (buckets, total, count) in histogram_items:
+        family, _ = _family(name)
+        help_text = descriptions.get(family, ("", name, ()))[1]
+        head(name, "histogram", help_text + " (latency in seconds)")
+        names = label_names(name)
+        cumulative = 0
+        for bound, bucket in zip(LATENCY_BUCKETS + ("+Inf",), buckets):
+            cumulative += bucket
+            le = 'le="%s"' % bound
+            lines.append(f"{name}_bucket{_labels(names, values, le)} {cumulative}")
+        lines.append(f"{name}_sum{_labels(names, values)} {total}")
+        lines.append(f"{name}_count{_labels(names, values)} {count}")
+
+    for name, func in list(callbacks.items()):
+        kind, help_text, names = descriptions[name]
+        try:
+            value = func()
+        except Exception as e:  # A broken gauge must not break the whole scrape
+            print(f"⚠️ Metric {name} failed: {e}")
+            continue
+        head(name, kind, help_text)
+        if isinstance(value, dict):
+            for label_value, number in sorted(value.items()):
+                lines.append(f"{name}{_labels(names, (label_value,))} {number}")
+        else:
+            lines.append(f"{name} {value}")
+
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,167 @@
+"""Rate-limited outgoing Telegram requests.
+
+Every chat gets its own queue and worker task, so messages to one chat keep
+their order while different chats are served concurrently. Before each send
+the worker takes a token from the chat's bucket and from the global bucket.
+Tokens may go negative; that turns into a wait. A FloodWaitError blocks only
+that chat for the time Telegram asked for, then the request is retried.
+Queued edits to the same message are merged into the latest one.
+"""
+import asyncio
+import time
+from collections import deque
+from telethon import errors
+import metrics
+
+GLOBAL_RATE = 25  # Requests per second across all chats
+GLOBAL_BURST = 30
+PRIVATE_RATE = 1.0  # Requests per second to one user
+PRIVATE_BURST = 3
+GROUP_RATE = 20 / 60  # Requests per second to one group
+GROUP_BURST = 5
+MAX_FLOOD_RETRIES = 3
+MAX_FLOOD_WAIT = 300  # Seconds; longer waits fail the request instead of holding the queue
+MAX_IDLE_BUCKETS = 10000  # Idle per-chat buckets kept before pruning full ones
+
+
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated", "blocked_until")
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def take(self):
+        """Reserves one token and returns how long to wait before using it."""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        return max(wait, self.blocked_until - now)
+
+    def is_full(self):
+        return self.tokens + (time.monotonic() - self.updated) * self.rate >= self.capacity
+
+
+class Job:
+    __slots__ = ("func", "args", "kwargs", "future", "edit_key", "queued_at")
+
+    def __init__(self, func, args, kwargs, future, edit_key=None):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.future = future
+        self.edit_key = edit_key
+        self.queued_at = time.monotonic()
+
+
+global_bucket = TokenBucket(GLOBAL_RATE, GLOBAL_BURST)
+buckets = {}  # Chat ID -> TokenBucket
+queues = {}  # Chat ID -> deque of Jobs waiting to be sent
+workers = {}  # Chat ID -> worker task, only while its queue has work
+pending_edits = {}  # (chat_id, message_id) -> queued edit Job
+
+metrics.describe("outbox_wait", "histogram", "Time outgoing requests spent queued")
+metrics.describe("outbox_flood_waits_total", "counter", "FloodWait errors from Telegram")
+metrics.describe("outbox_edits_coalesced_total", "counter", "Edits merged into an already queued edit")
+metrics.register_callback("outbox_queue_depth", "gauge", "Outgoing requests waiting to be sent",
+                          lambda: sum(len(queue) for queue in list(queues.values())))
+metrics.register_callback("outbox_active_chats", "gauge", "Chats with outgoing requests queued", lambda: len(workers))
+
+
+def _bucket(chat_id):
+    bucket = buckets.get(chat_id)
+    if bucket is None:
+        if len(buckets) >= MAX_IDLE_BUCKETS:
+            for idle in [key for key, value in buckets.items() if key not in workers and value.is_full()]:
+                del buckets[idle]
+        rate, burst = (GROUP_RATE, GROUP_BURST) if chat_id < 0 else (PRIVATE_RATE, PRIVATE_BURST)
+        bucket = buckets[chat_id] = TokenBucket(rate, burst)
+    return bucket
+
+
+def log_failure(future):
+    """Done-callback for futures nobody awaits, so their errors still show up in the log."""
+    if not future.cancelled() and future.exception() is not None:
+        print(f"🔴 Outgoing Telegram request failed: {future.exception()}")
+
+
+def _enqueue(chat_id, job):
+    queues.setdefault(chat_id, deque()).append(job)
+    if chat_id not in workers:
+        workers[chat_id] = asyncio.get_running_loop().create_task(_work(chat_id))
+    return job.future
+
+
+def send(chat_id, func, *args, **kwargs):
+    """Queues `await func(*args, **kwargs)` for a chat. Returns a future with its result.
+
+    Callers that don't await it should add log_failure as a done-callback.
+    """
+    future = asyncio.get_running_loop().create_future()
+    return _enqueue(chat_id, Job(func, args, kwargs, future))
+
+
+def edit(chat_id, message_id, func, *args, **kwargs):
+    """Like send(), but replaces an edit of the same message that hasn't gone out yet.
+
+    Coalesced callers share one future, so it logs its own failure.
+    """
+    key = (chat_id, message_id)
+    job = pending_edits.get(key)
+    if job is not None:
+        job.args, job.kwargs = args, kwargs
+        metrics.inc("outbox_edits_coalesced_total")
+        return job.future
+
+    future = asyncio.get_running_loop().create_future()
+    future.add_done_callback(log_failure)
+    job = pending_edits[key] = Job(func, args, kwargs, future, edit_key=key)
+    return _enqueue(chat_id, job)
+
+
+async def _work(chat_id):
+    queue = queues[chat_id]
+    try:
+        while queue:
+            job = queue.popleft()
+            if job.edit_key is not None:
+                pending_edits.pop(job.edit_key, None)  # Later edits queue up behind this one
+            await _deliver(chat_id, job)
+    finally:
+        del workers[chat_id]
+        if not queue:
+            del queues[chat_id]
+
+
+async def _deliver(chat_id, job):
+    bucket = _bucket(chat_id)
+    for attempt in range(MAX_FLOOD_RETRIES + 1):
+        await asyncio.sleep(bucket.take())
+        await asyncio.sleep(global_bucket.take())
+        if attempt == 0:
+            metrics.observe("outbox_wait_seconds", time.monotonic() - job.queued_at)
+
+        try:
+            result = await job.func(*job.args, **job.kwargs)
+        except errors.FloodWaitError as e:
+            metrics.inc("outbox_flood_waits_total")
+            if e.seconds > MAX_FLOOD_WAIT or attempt == MAX_FLOOD_RETRIES:
+                if not job.future.done():  # The caller may have been cancelled meanwhile
+                    job.future.set_exception(e)
+                return
+            print(f"⚠️ FloodWait of {e.seconds}s for chat {chat_id}, holding its queue")
+            bucket.blocked_until = time.monotonic() + e.seconds
+            continue
+        except Exception as e:
+            if not job.future.done():
+                job.future.set_exception(e)
+            return
+
+        if not job.future.done():
+            job.future.set_result(result)
+        return
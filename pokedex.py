@@ -0,0 +1,131 @@
+import json
+import os
+import random
+
+# Bundled Pokédex built by build_pokedex.py
+POKEDEX_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "pokedex.json")
+
+# Order of the base stats stored for every species
+STAT_KEYS = ("hp", "attack", "defense", "special_attack", "special_defense", "speed")
+
+species_by_id = {}  # National dex number -> species entry
+species_by_name = {}  # Lowercase PokeAPI name -> species entry
+species_ids = []  # Dex numbers, kept as a list for random picks
+
+# Evolution graph, built once from the Pokédex (and extended with PokeAPI chains)
+next_stages = {}  # Name -> tuple of names it can evolve into (empty for final forms)
+evolves_from = {}  # Name -> name it evolves from
+stage_depth = {}  # Name -> 0 for base forms, 1 for first evolutions, ...
+EVOLUTION_COST = 10  # Copies needed to evolve into a form that can evolve again
+FINAL_EVOLUTION_COST = 20  # Copies needed to evolve into a final form
+
+
+def load_pokedex(path=POKEDEX_PATH):
+    """Loads the bundled Pokédex into memory, replacing anything loaded before."""
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+
+    species_by_id.clear()
+    species_by_name.clear()
+    species_ids.clear()
+
+    for entry in data["species"]:
+        species_by_id[entry["id"]] = entry
+        species_by_name[entry["name"]] = entry
+        species_ids.append(entry["id"])
+
+    build_evolution_graph()
+    print(f"📘 Loaded {len(species_by_id)} Pokémon from {os.path.basename(path)}")
+
+
+def build_evolution_graph():
+    """Indexes evolves_to of every loaded species into next_stages / evolves_from / stage_depth."""
+    next_stages.clear()
+    evolves_from.clear()
+    stage_depth.clear()
+
+    for entry in species_by_name.values():
+        add_evolutions(entry["name"], entry["evolves_to"])
+    for name in next_stages:
+        if name not in evolves_from:
+            _index_depth(name)  # Walks down from every base form
+
+
+def add_evolutions(name, evolutions):
+    """Records the direct evolutions of one species."""
+    next_stages[name] = tuple(evolutions)
+    for evolution in evolutions:
+        evolves_from[evolution] = name  # Unbundled ones get their own links once their chain is fetched
+
+
+def add_chain(chain):
+    """Records a whole PokeAPI evolution chain, every branch included."""
+    add_evolutions(chain["species"]["name"], [evo["species"]["name"] for evo in chain["evolves_to"]])
+    for evo in chain["evolves_to"]:
+        add_chain(evo)
+    _index_depth(chain["species"]["name"], stage_depth.get(chain["species"]["name"], 0))
+
+
+def _index_depth(name, depth=0):
+    stage_depth[name] = depth
+    for evolution in next_stages.get(name, ()):
+        _index_depth(evolution, depth + 1)
+
+
+def is_final(name):
+    """True if a known species doesn't evolve any further."""
+    return not next_stages.get(name.lower())
+
+
+def evolution_cost(name, evolution=None):
+    """Copies needed to evolve a species, or None if it can't evolve (into `evolution`).
+
+    Evolving into a form that still evolves costs EVOLUTION_COST, into a final
+    form FINAL_EVOLUTION_COST. Without `evolution`, the cheapest branch counts.
+    """
+    evolutions = next_stages.get(name.lower())
+    if not evolutions or (evolution is not None and evolution not in evolutions):
+        return None
+    if evolution is not None:
+        evolutions = (evolution,)
+    return min(FINAL_EVOLUTION_COST if is_final(evolution) else EVOLUTION_COST for evolution in evolutions)
+
+
+def save_pokedex(species, path=POKEDEX_PATH):
+    """Writes species entries to disk, one compact JSON object per line."""
+    species = sorted(species, key=lambda entry: entry["id"])
+    lines = [json.dumps(entry, separators=(",", ":")) for entry in species]
+
+    with open(path, "w", encoding="utf-8") as f:
+        f.write('{"version":1,"species":[\n')
+        f.write(",\n".join(lines))
+        f.write("\n]}\n")
+
+
+def get_species(pokemon_name):
+    """Returns the Pokédex entry for a Pokémon name, or None if it isn't bundled."""
+    return species_by_name.get(pokemon_name.lower())
+
+
+def random_species():
+    """Returns the entry of a random bundled Pokémon."""
+    return species_by_id[random.choice(species_ids)]
+
+
+def sample_names(count):
+    """Returns `count` distinct random Pokémon names."""
+    return [species_by_id[poke_id]["name"] for poke_id in random.sample(species_ids, count)]
+
+
+def stats_dict(entry):
+    """Builds the stats dict handed out by game_logic.get_pokemon_stats."""
+    stats = dict(zip(STAT_KEYS, entry["stats"]))
+    stats["name"] = entry["name"].capitalize()
+    stats["image"] = entry["image"]
+    return stats
+
+
+if os.path.exists(POKEDEX_PATH):
+    load_pokedex()
+else:
+    print(f"⚠️ {os.path.basename(POKEDEX_PATH)} is missing, run build_pokedex.py to create it")
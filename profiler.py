@@ -0,0 +1,96 @@
+"""On-demand profiling of the running bot.
+
+profile(seconds) switches on cProfile for the event-loop thread (where every
+handler runs), tracemalloc allocation tracking and an event-loop lag probe,
+lets the bot keep serving for that long, and returns a plain-text report.
+"""
+import asyncio
+import cProfile
+import io
+import pstats
+import time
+import tracemalloc
+
+DEFAULT_SECONDS = 30
+MAX_SECONDS = 300
+TOP_FUNCTIONS = 25
+TOP_ALLOCATIONS = 20
+LAG_INTERVAL = 0.05  # Seconds between event-loop lag samples
+TRACE_FRAMES = 5  # Stack depth kept per allocation
+
+running = False  # Only one profile at a time
+
+
+async def _sample_lag(samples, stop):
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        expected = loop.time() + LAG_INTERVAL
+        await asyncio.sleep(LAG_INTERVAL)
+        samples.append(max(0.0, loop.time() - expected))
+
+
+def _lag_report(samples):
+    if not samples:
+        return "No samples"
+    ordered = sorted(samples)
+    p99 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))]
+    return (f"{len(ordered)} samples every {LAG_INTERVAL * 1000:.0f} ms: "
+            f"mean {sum(ordered) / len(ordered) * 1000:.1f} ms, p99 {p99 * 1000:.1f} ms, max {ordered[-1] * 1000:.1f} ms")
+
+
+def _function_report(profiler, sort_key):
+    out = io.StringIO()
+    stats = pstats.Stats(profiler, stream=out)
+    stats.strip_dirs().sort_stats(sort_key).print_stats(TOP_FUNCTIONS)
+    return out.getvalue().strip()
+
+
+def _allocation_report(before, after):
+    lines = []
+    for stat in after.compare_to(before, "traceback")[:TOP_ALLOCATIONS]:
+        frame = stat.traceback[0]
+        lines.append(f"{stat.size_diff / 1024:+9.1f} KiB {stat.count_diff:+7d} blocks  {frame.filename}:{frame.lineno}")
+        for caller in list(stat.traceback)[1:3]:
+            lines.append(f"{'':30}from {caller.filename}:{caller.lineno}")
+    current, peak = tracemalloc.get_traced_memory()
+    lines.append(f"\nTraced now {current / 1024 / 1024:.1f} MiB, peak {peak / 1024 / 1024:.1f} MiB")
+    return "\n".join(lines)
+
+
+async def profile(seconds=DEFAULT_SECONDS):
+    """Profiles the live bot for `seconds` and returns the report as text."""
+    global running
+    if running:
+        raise RuntimeError("A profile is already running")
+    running = True
+
+    started_tracing = not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start(TRACE_FRAMES)
+    before = tracemalloc.take_snapshot()
+
+    samples = []
+    stop = asyncio.Event()
+    probe = asyncio.get_running_loop().create_task(_sample_lag(samples, stop))
+    profiler = cProfile.Profile()
+    start = time.perf_counter()
+    try:
+        profiler.enable()
+        await asyncio.sleep(seconds)
+    finally:
+        profiler.disable()
+        stop.set()
+        await probe
+        after = tracemalloc.take_snapshot()
+        if started_tracing:
+            tracemalloc.stop()
+        running = False
+
+    elapsed = time.perf_counter() - start
+    return "\n\n".join([
+        f"Profile of {elapsed:.1f}s taken {time.strftime('%Y-%m-%d %H:%M:%S')}",
+        "== Event-loop lag ==\n" + _lag_report(samples),
+        "== Top functions by own time ==\n" + _function_report(profiler, "tottime"),
+        "== Top functions by cumulative time ==\n" + _function_report(profiler, "cumulative"),
+        "== Top allocation sites (growth during the profile) ==\n" + _allocation_report(before, after),
+    ]) + "\n"
@@ -0,0 +1,147 @@
+"""Periodic snapshots of in-memory game state for warm restarts.
+
+File layout (all integers big-endian):
+    magic b"PKSNAP", version (u16), section count (u16), crc32 of everything after it (u32)
+    then per section: name length (u16), name, payload length (u32), payload
+
+Each payload is zlib-compressed JSON. Sections that haven't changed since the
+last save reuse their compressed bytes, and nothing is written at all when no
+section changed. The file is replaced atomically, and a snapshot that fails
+any check is ignored as a whole.
+
+The bot also saves once more when it shuts down (SIGTERM, Ctrl+C or a
+disconnect). After a SIGKILL or a power loss it restarts from the last
+periodic snapshot instead, up to SNAPSHOT_INTERVAL seconds out of date.
+"""
+import asyncio
+import json
+import os
+import struct
+import zlib
+
+SNAPSHOT_PATH = "game_state.snapshot"
+SNAPSHOT_VERSION = 1
+SNAPSHOT_INTERVAL = 15  # Seconds between snapshots
+MAGIC = b"PKSNAP"
+HEADER = struct.Struct(">6sHHI")
+
+sections = {}  # Name -> (dump function, load function)
+last_written = {}  # Name -> (raw JSON, compressed payload) from the last save
+
+
+def register(name, dump, load):
+    """Adds a piece of state to the snapshot.
+
+    `dump()` returns JSON-serialisable data, `load(data)` puts it back.
+    """
+    sections[name] = (dump, load)
+
+
+def _encode_sections():
+    """Returns [(name, payload)] and whether anything changed since the last save."""
+    encoded = []
+    changed = False
+    for name, (dump, _) in sections.items():
+        raw = json.dumps(dump(), separators=(",", ":"))
+        previous = last_written.get(name)
+        if previous and previous[0] == raw:
+            payload = previous[1]
+        else:
+            payload = zlib.compress(raw.encode(), 6)
+            last_written[name] = (raw, payload)
+            changed = True
+        encoded.append((name, payload))
+    return encoded, changed
+
+
+def _write(path, encoded):
+    body = b"".join(
+        struct.pack(">H", len(name.encode())) + name.encode() + struct.pack(">I", len(payload)) + payload
+        for name, payload in encoded
+    )
+    header = HEADER.pack(MAGIC, SNAPSHOT_VERSION, len(encoded), zlib.crc32(body))
+
+    tmp_path = path + ".tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(header + body)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except OSError:
+        last_written.clear()  # Make sure the next save writes everything again
+        raise
+
+
+def save(path=SNAPSHOT_PATH, force=False):
+    """Writes a snapshot if the state changed (or `force` is set). Returns True if written."""
+    encoded, changed = _encode_sections()
+    if not changed and not force:
+        return False
+    _write(path, encoded)
+    return True
+
+
+def _read(path):
+    """Parses and verifies a snapshot file. Returns {name: data} or None if it's unusable."""
+    with open(path, "rb") as f:
+        blob = f.read()
+
+    if len(blob) < HEADER.size:
+        return None
+    magic, version, count, checksum = HEADER.unpack_from(blob)
+    body = blob[HEADER.size:]
+    if magic != MAGIC or version != SNAPSHOT_VERSION or zlib.crc32(body) != checksum:
+        return None
+
+    state = {}
+    offset = 0
+    for _ in range(count):
+        (name_len,) = struct.unpack_from(">H", body, offset)
+        offset += 2
+        name = body[offset:offset + name_len].decode()
+        offset += name_len
+        (payload_len,) = struct.unpack_from(">I", body, offset)
+        offset += 4
+        state[name] = json.loads(zlib.decompress(body[offset:offset + payload_len]))
+        offset += payload_len
+    return state
+
+
+def restore(path=SNAPSHOT_PATH):
+    """Loads the last snapshot into the registered state. Returns True on success."""
+    if not os.path.exists(path):
+        return False
+
+    try:
+        state = _read(path)
+    except (OSError, ValueError, struct.error, zlib.error) as e:
+        print(f"⚠️ Ignoring unreadable snapshot: {e}")
+        return False
+
+    if state is None:
+        print("⚠️ Ignoring snapshot with a bad checksum or version")
+        return False
+
+    # Everything decoded fine, only now touch the live state
+    for name, (_, load) in sections.items():
+        if name in state:
+            load(state[name])
+    print(f"🟢 Restored {len(state)} state sections from {path}")
+    return True
+
+
+async def autosave(interval=SNAPSHOT_INTERVAL, path=SNAPSHOT_PATH):
+    """Saves a snapshot every `interval` seconds.
+
+    State is captured on the event loop, the file is written on a worker thread.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            encoded, changed = _encode_sections()
+            if changed:
+                await loop.run_in_executor(None, _write, path, encoded)
+        except OSError as e:
+            print(f"⚠️ Snapshot failed: {e}")
@@ -0,0 +1,71 @@
+"""Base stats of every bundled Pokémon as one NumPy array.
+
+Row i holds the six stats (in pokedex.STAT_KEYS order) of the species whose
+name maps to i in `row_by_name`. The last row is all zeros and stands in for
+unknown names, so lookups over whole lineups never need a Python branch.
+"""
+import numpy as np
+import pokedex
+
+STAT_COLUMNS = {stat: column for column, stat in enumerate(pokedex.STAT_KEYS)}
+
+stats = np.zeros((1, len(pokedex.STAT_KEYS)), dtype=np.int16)  # Species x stat
+row_by_name = {}  # Lowercase name -> row in `stats`
+UNKNOWN_ROW = 0  # All-zero row, moved to the end by build()
+
+
+def build():
+    """(Re)builds the matrix from the loaded Pokédex."""
+    global stats, UNKNOWN_ROW
+    entries = sorted(pokedex.species_by_id.values(), key=lambda entry: entry["id"])
+
+    matrix = np.zeros((len(entries) + 1, len(pokedex.STAT_KEYS)), dtype=np.int16)
+    row_by_name.clear()
+    for row, entry in enumerate(entries):
+        matrix[row] = entry["stats"]
+        row_by_name[entry["name"]] = row
+
+    stats = matrix
+    UNKNOWN_ROW = len(entries)
+
+
+def stat_value(pokemon_name, stat):
+    """Returns one base stat of a bundled Pokémon, or None if it isn't bundled."""
+    row = row_by_name.get(pokemon_name.lower())
+    if row is None:
+        return None
+    return int(stats[row, STAT_COLUMNS[stat]])
+
+
+def rows_for(names):
+    """Maps names (any nesting of lists) to an int array of rows; unknown names get the zero row."""
+    names = np.asarray(names, dtype=object)
+    flat = [row_by_name.get(name.lower(), UNKNOWN_ROW) for name in names.ravel()]
+    return np.array(flat, dtype=np.intp).reshape(names.shape)
+
+
+def columns_for(stat_names):
+    """Maps stat names (any nesting of lists) to an int array of columns."""
+    stat_names = np.asarray(stat_names, dtype=object)
+    flat = [STAT_COLUMNS[stat] for stat in stat_names.ravel()]
+    return np.array(flat, dtype=np.intp).reshape(stat_names.shape)
+
+
+def score_rounds(rows1, columns1, rows2, columns2):
+    """Scores any number of battles at once.
+
+    Every argument is an int array of the same shape (..., rounds): the Pokémon
+    row each side sends out per round and the stat column it picks. Returns
+    (wins1, wins2) with the round axis summed away; ties count for nobody.
+    """
+    values1 = stats[rows1, columns1]
+    values2 = stats[rows2, columns2]
+    return (values1 > values2).sum(axis=-1), (values2 > values1).sum(axis=-1)
+
+
+def lineup_totals(rows):
+    """Sums each stat over a lineup: (..., lineup size) rows -> (..., 6) totals."""
+    return stats[rows].sum(axis=-2, dtype=np.int32)
+
+
+build()
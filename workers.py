@@ -0,0 +1,167 @@
+"""Receiver/worker split for group-message handling.
+
+The main process keeps the Telegram connection and forwards every group
+message to one of N worker processes, picked by chat_id so that each chat
+is always handled by the same worker, in order. Workers run the catch and
+spawn logic against SQLite and send back what should be posted, which the
+main process then sends to Telegram.
+
+Workers are forked, so create the pool before the main process opens any
+database connection (or after close_db()) and before it starts any thread.
+"""
+import asyncio
+import multiprocessing
+import signal
+import database
+import game_logic
+import snapshot
+import async_db
+import leaderboard
+from concurrent.futures import ThreadPoolExecutor
+
+SPAWN_REPORT_INTERVAL = 5  # Seconds between spawn counts sent to the main process for /metrics
+
+
+def _snapshot_path(index):
+    return f"{snapshot.SNAPSHOT_PATH}.worker{index}"
+
+
+async def _report_spawns(index, outbox):
+    """Sends this worker's live and pre-rolled spawn counts to the main process's gauges."""
+    while True:
+        queued = game_logic.spawn_queue.qsize() if game_logic.spawn_queue else 0
+        outbox.put(("spawns", index, len(game_logic.current_pokemon), queued))
+        await asyncio.sleep(SPAWN_REPORT_INTERVAL)
+
+
+async def _serve(index, inbox, outbox):
+    database.start_write_behind()
+    game_logic.load_thresholds()
+
+    # Each worker snapshots the spawn state of its own chats
+    snapshot.sections.clear()
+    snapshot.last_written.clear()
+    snapshot.register("message_counts", lambda: list(game_logic.message_counts.items()),
+                      lambda pairs: game_logic.message_counts.update((k, v) for k, v in pairs))
+    snapshot.register("current_pokemon", game_logic.dump_spawns, game_logic.load_spawns)
+    snapshot.restore(_snapshot_path(index))
+
+    loop = asyncio.get_running_loop()
+    # A SIGTERM sent straight to a worker shuts it down like WorkerPool.stop() does
+    loop.add_signal_handler(signal.SIGTERM, inbox.put, None)
+    background = [
+        loop.create_task(game_logic.spawn_producer()),
+        loop.create_task(game_logic.spawn_sweeper()),
+        loop.create_task(snapshot.autosave(path=_snapshot_path(index))),
+        loop.create_task(_report_spawns(index, outbox)),
+    ]
+    reader = ThreadPoolExecutor(max_workers=1, thread_name_prefix="inbox")
+
+    while True:
+        item = await loop.run_in_executor(reader, inbox.get)
+        if item is None:  # Shutdown
+            break
+
+        kind = item[0]
+        if kind == "message":
+            _, chat_id, message_id, user_id, username, text = item
+            try:
+                action = await game_logic.handle_group_message(chat_id, user_id, username, text)
+            except Exception as e:
+                print(f"🔴 Worker {index} failed on a message in {chat_id}: {e}")
+                continue
+            if action:
+                if action[0] == "caught":  # The main process reads the collection once the reply is out
+                    await async_db.flush_writes()
+                outbox.put(("reply", chat_id, message_id, user_id, username, action))
+        elif kind == "threshold":
+            _, chat_id, threshold = item
+            game_logic.thresholds[chat_id] = threshold
+
+    for task in background:
+        task.cancel()
+    snapshot.save(_snapshot_path(index), force=True)
+    async_db.shutdown()
+    database.close_db()
+
+
+def worker_main(index, inbox, outbox):
+    """Entry point of a worker process."""
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        loop.run_until_complete(_serve(index, inbox, outbox))
+    except KeyboardInterrupt:
+        pass
+    print(f"🟢 Worker {index} stopped")
+
+
+class WorkerPool:
+    """Forwards group messages to worker processes partitioned by chat_id."""
+
+    def __init__(self, count):
+        ctx = multiprocessing.get_context("fork")
+        self.inboxes = [ctx.Queue() for _ in range(count)]
+        self.outbox = ctx.Queue()
+        self.processes = [
+            ctx.Process(target=worker_main, args=(index, inbox, self.outbox), name=f"worker-{index}", daemon=True)
+            for index, inbox in enumerate(self.inboxes)
+        ]
+        for process in self.processes:
+            process.start()
+        self.reader = ThreadPoolExecutor(max_workers=1, thread_name_prefix="outbox")
+        self.chat_tails = {}  # chat_id -> last reply task, so replies per chat go out in order
+        self.active_spawns = [0] * count  # Latest count reported by each worker
+        self.queued_spawns = [0] * count
+        print(f"🟢 Started {count} worker processes")
+
+    def _inbox(self, chat_id):
+        return self.inboxes[chat_id % len(self.inboxes)]
+
+    def submit(self, chat_id, message_id, user_id, username, text):
+        """Hands a group message to the worker that owns this chat."""
+        self._inbox(chat_id).put(("message", chat_id, message_id, user_id, username, text))
+
+    def set_threshold(self, chat_id, threshold):
+        """Tells the owning worker about a changed drop time."""
+        self._inbox(chat_id).put(("threshold", chat_id, threshold))
+
+    async def pump_replies(self, handle):
+        """Runs `await handle(chat_id, message_id, username, action)` for every worker result."""
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await loop.run_in_executor(self.reader, self.outbox.get)
+            if item is None:  # Pool stopped
+                return
+            if item[0] == "spawns":
+                _, index, self.active_spawns[index], self.queued_spawns[index] = item
+                continue
+            _, chat_id, message_id, user_id, username, action = item
+            if action[0] == "caught":  # Mirror the catch into this process's leaderboards
+                leaderboard.add_user(user_id, username)
+                leaderboard.add_catch(user_id, action[1])
+            previous = self.chat_tails.get(chat_id)
+            task = loop.create_task(self._after(previous, handle(chat_id, message_id, username, action)))
+            self.chat_tails[chat_id] = task
+            task.add_done_callback(lambda done, chat_id=chat_id: self._forget(chat_id, done))
+
+    async def _after(self, previous, coro):
+        if previous is not None:
+            await asyncio.wait([previous])
+        try:
+            await coro
+        except Exception as e:
+            print(f"🔴 Failed to send a worker reply: {e}")
+
+    def _forget(self, chat_id, task):
+        if self.chat_tails.get(chat_id) is task:
+            del self.chat_tails[chat_id]
+
+    def stop(self, timeout=10):
+        """Asks every worker to flush and exit, then waits for them."""
+        for inbox in self.inboxes:
+            inbox.put(None)
+        for process in self.processes:
+            process.join(timeout)
+        self.outbox.put(None)  # Releases the reply reader
+        self.reader.shutdown(wait=True)